@@ -0,0 +1,83 @@
+"""Benchmark parsing a large tox.ini: substitutions, brace expansion and
+resolving the deps and commands of each env.
+
+Usage: python benchmarks/bench_config.py
+
+"""
+import os
+import sys
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import default_timer as timer
+
+# Import the ctox in this checkout, it needn't be installed.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ctox.config import read_config, get_envlist, get_deps, get_commands
+from ctox.main import Env
+from ctox.subst import bash_expand, replace_braces
+
+from synthetic import write_project
+
+
+def best_of(f, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = timer()
+        f()
+        best = min(best, timer() - start)
+    return best
+
+
+def make_envs(toxinidir):
+    """An Env (without its plan resolved) for each env in the envlist."""
+    config = read_config(os.path.join(toxinidir, "tox.ini"))
+    plan = {'changedir': None, 'whitelist': [], 'deps': [], 'commands': [],
+            'requirements': None}
+    toxdir = os.path.join(toxinidir, ".tox")
+    return [Env(name=name, config=config, options=[], toxdir=toxdir,
+                toxinidir=toxinidir, package="benchproj-0.1", plan=plan)
+            for name in get_envlist(config)]
+
+
+def run():
+    """Returns a dict of benchmark name to (best) seconds."""
+    results = {}
+    tmp = mkdtemp()
+    try:
+        toxinidir = write_project(os.path.join(tmp, "proj"), n_py=5,
+                                  n_factors=5, n_deps=50, n_commands=20)
+
+        # The first pass includes reading the config (and filling caches).
+        start = timer()
+        envs = make_envs(toxinidir)
+        for env in envs:
+            get_deps(env)
+            get_commands(env)
+        results['config.first_pass'] = timer() - start
+
+        results['config.get_deps'] = best_of(
+            lambda: [get_deps(env) for env in envs])
+        results['config.get_commands'] = best_of(
+            lambda: [get_commands(env) for env in envs])
+
+        s = " ".join("{envpython} {toxinidir}/t%d {posargs:-x}" % i
+                     for i in range(100))
+        results['subst.replace_braces'] = best_of(
+            lambda: [replace_braces(s, env) for env in envs])
+
+        s = "py{26,27,33,34,35,36}-django{15,16,17,18,19}-{a,b,c,d}-{x,y,z}"
+        results['subst.bash_expand'] = best_of(
+            lambda: [bash_expand(s) for _ in range(100)])
+    finally:
+        rmtree(tmp)
+    return results
+
+
+def main():
+    for name, seconds in sorted(run().items()):
+        print("%-30s %10.4f" % (name, seconds))
+
+
+if __name__ == '__main__':
+    main()
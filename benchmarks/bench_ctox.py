@@ -0,0 +1,74 @@
+"""Benchmark whole ctox runs, against the fake conda in benchmarks/fakebin.
+
+This measures scheduling, caching and parallelism without a network (or
+conda). The fake conda (and its pip) sleep $CTOX_FAKE_DELAY seconds per call,
+default 0.05, so the results are mostly the number of calls ctox makes and
+how well it overlaps them.
+
+Usage: python benchmarks/bench_ctox.py
+
+"""
+import os
+import sys
+from shutil import rmtree
+from subprocess import call
+from tempfile import mkdtemp
+from timeit import default_timer as timer
+
+from synthetic import write_project
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKEBIN = os.path.join(HERE, "fakebin")
+
+# name, ctox arguments and whether to start without a .tox (and cache).
+SCENARIOS = [("serial.cold", [], True),
+             ("serial.warm", [], False),
+             ("serial.posargs", ["--", "-x"], False),
+             ("parallel4.cold", ["-p", "4"], True),
+             ("parallel4.warm", ["-p", "4"], False)]
+
+
+def run_ctox(toxinidir, args):
+    """Run ctox (python -m ctox) in toxinidir, returns the seconds taken."""
+    env = dict(os.environ)
+    env["PATH"] = FAKEBIN + os.pathsep + env.get("PATH", "")
+    env.pop("CTOX_CACHE_DIR", None)
+    # Use this checkout of ctox, rather than any installed one.
+    root = os.path.dirname(HERE)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [root] + [p for p in [env.get("PYTHONPATH")] if p])
+    with open(os.devnull, "w") as fnull:
+        start = timer()
+        ret = call([sys.executable, "-m", "ctox"] + args, cwd=toxinidir,
+                   env=env, stdout=fnull, stderr=fnull)
+        took = timer() - start
+    if ret != 0:
+        raise RuntimeError("ctox %s failed in %s" % (" ".join(args),
+                                                     toxinidir))
+    return took
+
+
+def run():
+    """Returns a dict of benchmark name to seconds."""
+    results = {}
+    tmp = mkdtemp()
+    try:
+        toxinidir = write_project(os.path.join(tmp, "proj"), n_py=3,
+                                  n_factors=2, n_deps=6, n_commands=2,
+                                  sleep=0.1)
+        for name, args, cold in SCENARIOS:
+            if cold:
+                rmtree(os.path.join(toxinidir, ".tox"), ignore_errors=True)
+            results["ctox." + name] = run_ctox(toxinidir, args)
+    finally:
+        rmtree(tmp)
+    return results
+
+
+def main():
+    for name, seconds in sorted(run().items()):
+        print("%-30s %10.4f" % (name, seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Benchmark expanding large envlists.
+
+Usage: python benchmarks/bench_envlist.py
+
+"""
+import os
+import sys
+from timeit import default_timer as timer
+
+# Import the ctox in this checkout, it needn't be installed.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ctox.subst import parse_envlist
+
+
+def envlist(n_py, n_django, n_db):
+    return "py{%s}-django{%s}-db{%s}-{cov,nocov}, flake8" % (
+        ",".join("%02d" % i for i in range(n_py)),
+        ",".join(str(i) for i in range(n_django)),
+        ",".join("db%s" % i for i in range(n_db)))
+
+
+def bench(s, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = timer()
+        n = len(parse_envlist(s))
+        best = min(best, timer() - start)
+    return n, best
+
+
+def run():
+    """Returns a dict of benchmark name to (best) seconds."""
+    results = {}
+    for size in (10, 40):
+        n, t = bench(envlist(size, size, size))
+        results['envlist.parse_%d' % n] = t
+    return results
+
+
+def main():
+    print("%10s %12s %14s" % ("envs", "seconds", "envs/second"))
+    for size in (2, 5, 10, 20, 40):
+        n, t = bench(envlist(size, size, size))
+        print("%10d %12.4f %14.0f" % (n, t, n / t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Run all the benchmarks, optionally saving the results as json to compare
+against those of another commit.
+
+Usage: python benchmarks/run.py [--json FILE] [--compare OLD_FILE] [NAME ...]
+
+e.g. to compare a branch against master:
+
+    git checkout master && python benchmarks/run.py --json master.json
+    git checkout branch && python benchmarks/run.py --compare master.json
+
+"""
+import json
+import os
+import platform
+import sys
+from argparse import ArgumentParser
+from subprocess import check_output
+
+import bench_config
+import bench_ctox
+import bench_envlist
+
+BENCHMARKS = {'config': bench_config, 'ctox': bench_ctox,
+              'envlist': bench_envlist}
+
+
+def commit():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.devnull, "w") as fnull:
+            out = check_output(["git", "rev-parse", "--short", "HEAD"],
+                               cwd=here, stderr=fnull)
+        return out.decode("utf-8").strip()
+    except Exception:
+        return None
+
+
+def main(arguments=None):
+    parser = ArgumentParser(description="Run the ctox benchmarks.")
+    parser.add_argument('names', nargs='*',
+                        help='which of %s to run (default: all)'
+                             % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--json', help='write the results to FILE',
+                        metavar='FILE')
+    parser.add_argument('--compare', help='compare with the results in FILE',
+                        metavar='FILE')
+    args = parser.parse_args(arguments)
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks %s" % ', '.join(sorted(unknown)))
+
+    results = {}
+    for name in args.names or sorted(BENCHMARKS):
+        results.update(BENCHMARKS[name].run())
+
+    old = {}
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)['results']
+
+    if old:
+        print("%-30s %10s %10s %8s" % ("", "old", "new", "speedup"))
+    for name, seconds in sorted(results.items()):
+        if name in old:
+            print("%-30s %10.4f %10.4f %7.2fx" % (name, old[name], seconds,
+                                                  old[name] / seconds))
+        else:
+            print("%-30s %10.4f" % (name, seconds))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'commit': commit(),
+                       'python': platform.python_version(),
+                       'platform': sys.platform,
+                       'delay': os.environ.get('CTOX_FAKE_DELAY', '0.05'),
+                       'results': results}, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
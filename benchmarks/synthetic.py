@@ -0,0 +1,62 @@
+"""Write synthetic projects (a setup.py and a large tox.ini) to benchmark
+against."""
+import os
+import sys
+
+# Import the ctox in this checkout, it needn't be installed.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ctox.main import SUPPORTED_ENVS
+
+SETUP_PY = """from setuptools import setup
+setup(name='benchproj', version='0.1', packages=['benchproj'])
+"""
+
+TOX_INI = """[tox]
+envlist = {envlist}
+
+[base]
+deps =
+{base_deps}
+
+[testenv]
+changedir = {{toxinidir}}
+deps =
+    {{[base]deps}}
+{deps}
+commands =
+{commands}
+"""
+
+
+def tox_ini(n_py=3, n_factors=2, n_deps=10, n_commands=2, sleep=0):
+    """A tox.ini with an envlist of n_py (up to 5) pythons times n_factors ** 2
+    factors, and deps and commands with factor conditions and
+    substitutions."""
+    pys = [e[2:] for e in SUPPORTED_ENVS][-n_py:]
+    dj = ["dj%d" % i for i in range(n_factors)]
+    db = ["db%d" % i for i in range(n_factors)]
+    envlist = "py{%s}-{%s}-{%s}" % (",".join(pys), ",".join(dj),
+                                    ",".join(db))
+    base_deps = "\n".join("    base%d" % i for i in range(n_deps))
+    deps = "\n".join("    %s: lib%d==1.%d" % (f, i, i)
+                     for i in range(n_deps)
+                     for f in (dj + db)[i % len(dj + db):][:1])
+    commands = "\n".join(
+        "    {envpython} -c \"import time; time.sleep(%s)\" "
+        "{posargs:--run %d} {env:CTOX_BENCH_MISSING:default}" % (sleep, i)
+        for i in range(n_commands))
+    return TOX_INI.format(envlist=envlist, base_deps=base_deps, deps=deps,
+                          commands=commands)
+
+
+def write_project(path, **kwargs):
+    """Write a setup.py, package and tox.ini (see tox_ini) to path."""
+    os.makedirs(os.path.join(path, "benchproj"))
+    with open(os.path.join(path, "benchproj", "__init__.py"), "w") as f:
+        f.write("")
+    with open(os.path.join(path, "setup.py"), "w") as f:
+        f.write(SETUP_PY)
+    with open(os.path.join(path, "tox.ini"), "w") as f:
+        f.write(tox_ini(**kwargs))
+    return path
@@ -0,0 +1,276 @@
+"""This module contains the cache of conda environments, these are keyed on
+the python version and dependancies so can be shared between different tox
+environments (and projects), fingerprinting of the project's files and the
+(opt-in) cache of successful test runs.
+
+Note: the actual cloning is done by pkg.cache_env and pkg.create_env.
+
+"""
+
+import hashlib
+import json
+import os
+import posixpath
+import re
+
+CACHED_MARKER = "ctox-cached"
+
+
+def env_key(env):
+    """A hash of env's python version and its normalized dependancies.
+
+    Example
+    -------
+    >>> env_key(Env(name="py34", deps=["pip", "Django==1.8"], ...))
+    '7d1b...'
+
+    """
+    deps = sorted(set(_normalize_dep(d) for d in env.deps))
+    s = json.dumps([env.py_version, deps])
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+def _normalize_dep(dep):
+    # Note: package names are case insensitive and - and _ are equivalent.
+    return dep.strip().lower().replace('_', '-')
+
+
+def dep_name(dep):
+    """The normalized package name of a pip or conda spec.
+
+    Example
+    -------
+    >>> dep_name("Django_Foo>=1.8")
+    'django-foo'
+    >>> dep_name("six[version='>=1.0']")
+    'six'
+
+    """
+    m = re.match(r"\s*([A-Za-z0-9_.\-]+)", dep)
+    return _normalize_dep(m.group(1)) if m else _normalize_dep(dep)
+
+
+def read_json(path, default=None):
+    """Read json from path, returns default if missing or corrupt."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def write_json(path, data):
+    """Write data as json to path.
+
+    Note: this is written to a temporary file first and then moved, so
+    concurrent readers never see a half-written file.
+
+    """
+    d = os.path.dirname(path)
+    if d and not os.path.isdir(d):
+        try:
+            os.makedirs(d)
+        except OSError:  # pragma: no cover
+            # Created concurrently.
+            pass
+    tmp = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    try:
+        os.rename(tmp, path)
+    except OSError:  # pragma: no cover
+        # On windows rename fails if path already exists.
+        os.remove(path)
+        os.rename(tmp, path)
+
+
+def cached_env_path(env):
+    return os.path.join(env.cachedir, "envs", env_key(env))
+
+
+def lock_path(env):
+    """The lockfile in the cache for envs with env's python version and
+    deps."""
+    return os.path.join(env.cachedir, "locks", env_key(env) + ".json")
+
+
+def index_path(env):
+    """The index of which deps were previously installed by conda or pip, for
+    env's backend and python version (what conda can find depends on both).
+    """
+    return os.path.join(env.cachedir, "index",
+                        "%s-py%s.json" % (env.backend.exe, env.py_version))
+
+
+def base_env_path(env):
+    """The clean env (just python) for env's python version."""
+    return os.path.join(env.cachedir, "base", "py%s" % env.py_version)
+
+
+def result_key(env, fingerprint):
+    """A hash of everything which determines the outcome of env's commands:
+    the project's fingerprint (see tree_fingerprint), env's lockfile, its
+    commands, changedir and the posargs.
+
+    Returns None if env hasn't a lockfile (so can't be cached).
+
+    """
+    lock = read_json(env.envlockfile)
+    if lock is None or fingerprint is None:
+        return None
+    from ctox.main import positional_args
+    s = json.dumps([fingerprint, lock, env.commands, env.changedir,
+                    list(positional_args(env.options))], sort_keys=True)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+def passed_before(env, key):
+    """Whether env's commands succeeded the last time they were run with the
+    result_key key."""
+    try:
+        with open(env.envpassedfile) as f:
+            return key is not None and f.read().strip() == key
+    except (IOError, OSError):
+        return False
+
+
+def mark_passed(env, key):
+    """Record env's commands succeeded (key None means they failed)."""
+    if key is None:
+        if os.path.exists(env.envpassedfile):
+            os.remove(env.envpassedfile)
+    else:
+        with open(env.envpassedfile, 'w') as f:
+            f.write(key)
+
+
+def is_cached(path):
+    """Whether path is a complete cached environment.
+
+    Note: the marker is only written once the environment has been cloned
+    successfully, a half-finished clone is never used.
+
+    """
+    return os.path.isfile(os.path.join(path, CACHED_MARKER))
+
+
+def mark_cached(path):
+    with open(os.path.join(path, CACHED_MARKER), 'w') as f:
+        f.write("")
+
+
+# Files which determine what's in the sdist, these are always fingerprinted.
+SETUP_FILES = ('setup.py', 'setup.cfg', 'MANIFEST.in', 'pyproject.toml')
+# Directories in the project's root which are never part of the sdist.
+IGNORE_DIRS = ('build', 'dist')
+IGNORE_EXTS = ('.pyc', '.pyo')
+
+
+def sdist_sources(zipped):
+    """The paths (relative to the project's root) of the files in the sdist
+    zipped."""
+    from zipfile import ZipFile
+    z = ZipFile(zipped)
+    try:
+        names = z.namelist()
+    finally:
+        z.close()
+    # Each file is beneath the "name-version/" directory.
+    sources = [n.split('/', 1)[1] for n in names
+               if '/' in n and not n.endswith('/')]
+    # Skip the metadata, which the sdist generates.
+    return sorted(rel for rel in sources
+                  if rel != 'PKG-INFO' and
+                  not rel.split('/')[0].endswith('.egg-info'))
+
+
+def tree_fingerprint(root, sources, index=None):
+    """Fingerprint the files beneath root which are in the project's sdist.
+
+    sources are the files in the previous sdist (see sdist_sources), files
+    which are added to the sdist are noticed as the fingerprint also covers
+    the names in each directory containing sources (and the directories in
+    root). Other files, e.g. reports written into root, are ignored.
+
+    index is a dict of relative path to [mtime, size, inode, sha1] from a
+    previous call, files whose stats are unchanged aren't re-hashed.
+
+    Returns a tuple (fingerprint, index).
+
+    """
+    if index is None:
+        index = {}
+    new_index = {}
+    for rel in sorted(set(sources) | set(SETUP_FILES)):
+        path = os.path.join(root, *rel.split('/'))
+        try:
+            st = os.stat(path)
+        except OSError:
+            # e.g. setup.cfg, which the sdist may add.
+            continue
+        stat = [st.st_mtime, st.st_size, st.st_ino]
+        prev = index.get(rel)
+        if prev and prev[:3] == stat:
+            new_index[rel] = prev
+        else:
+            new_index[rel] = stat + [file_hash(path)]
+
+    listings = {'': sorted(d for d in _listdir(root)
+                           if os.path.isdir(os.path.join(root, d)) and
+                           d not in IGNORE_DIRS and
+                           not d.endswith('.egg-info'))}
+    for rel in set(posixpath.dirname(rel) for rel in sources) - set(['']):
+        listings[rel] = sorted(_listdir(os.path.join(root, *rel.split('/'))))
+
+    h = hashlib.sha1()
+    for rel in sorted(new_index):
+        h.update(("%s %s\n" % (rel, new_index[rel][3])).encode('utf-8'))
+    for rel in sorted(listings):
+        h.update(("%s/ %s\n" % (rel, listings[rel])).encode('utf-8'))
+    return h.hexdigest(), new_index
+
+
+def _listdir(path):
+    """The names in path, other than hidden and compiled files."""
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return []
+    return [n for n in names if not (n.startswith('.') or n == '__pycache__'
+                                     or n.endswith(IGNORE_EXTS))]
+
+
+def file_stamp(path):
+    """The [mtime, size, sha1] of path (None if it doesn't exist), see
+    files_unchanged."""
+    if not os.path.isfile(path):
+        return None
+    st = os.stat(path)
+    return [st.st_mtime, st.st_size, file_hash(path)]
+
+
+def files_unchanged(stamps):
+    """Whether each of the files in stamps (a dict of path to file_stamp) is
+    unchanged, the files are only hashed if their stats have changed."""
+    for path, stamp in stamps.items():
+        try:
+            st = os.stat(path)
+        except OSError:
+            if stamp is None:
+                # It still doesn't exist.
+                continue
+            return False
+        if stamp is None:
+            return False
+        if [st.st_mtime, st.st_size] != stamp[:2] and \
+                file_hash(path) != stamp[2]:
+            return False
+    return True
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
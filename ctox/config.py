@@ -5,6 +5,7 @@ Note: Substitutions functions can be found in subst.py.
 
 """
 
+import os
 import re
 try:
     from configparser import ConfigParser as SafeConfigParser, NoSectionError, NoOptionError
@@ -38,6 +39,18 @@ def get_whitelist(config):
     return _get(config, 'tox', 'whitelist_externals').split("\n")
 
 
+def get_backend_name(config):
+    """The [ctox] backend option, e.g. conda (the default) or mamba."""
+    return _get(config, 'ctox', 'backend') or 'conda'
+
+
+def get_result_cache(config):
+    """The [ctox] result_cache option, whether to skip the commands of envs
+    which are unchanged since they last succeeded (default False)."""
+    value = _get(config, 'ctox', 'result_cache').lower()
+    return value in ('true', 'yes', '1', 'on')
+
+
 def get_changedir(env):
     "changedir = {envdir}"
     from ctox.subst import replace_braces
@@ -53,18 +66,25 @@ def get_envlist(config):
     return parse_envlist(_get(config, 'tox', 'envlist'))
 
 
+def get_requirements_file(env):
+    """The path of the requirements file if deps is -r{path}, else None."""
+    from ctox.subst import replace_braces
+    env_deps = _get_env_maybe(env, "testenv", "deps").strip()
+    if env_deps.startswith('-r'):
+        return replace_braces(env_deps[2:].strip(), env)
+
+
 def get_deps(env):
-    from ctox.subst import replace_braces, expand_factor_conditions
+    from ctox.subst import replace_braces, expand_factor_lines
     env_deps = _get_env_maybe(env, "testenv", "deps").strip()
 
-    if env_deps.startswith('-r'):
-        requirements_txt = replace_braces(env_deps[2:].strip(), env)
+    requirements_txt = get_requirements_file(env)
+    if requirements_txt:
         with open(requirements_txt) as f:
             env_deps = f.read().strip()
 
-    env_deps = [replace_braces(expand_factor_conditions(d, env),
-                               env)
-                for d in env_deps.split("\n")
+    env_deps = [replace_braces(d, env)
+                for d in expand_factor_lines(env_deps, env)
                 if d]
 
     env_deps = [d for d in sum((s.split() for s in env_deps), [])
@@ -82,3 +102,60 @@ def get_commands(env):
     return [split_on(cmd)
             for cmd in split_on(replace_braces(commands, env), '\n')
             if cmd]
+
+
+def env_plan(env):
+    """The fully resolved deps, commands, changedir and whitelist of env (and
+    its requirements file, if it has one)."""
+    return {'changedir': get_changedir(env),
+            'whitelist': get_whitelist(env.config),
+            'deps': get_deps(env),
+            'commands': get_commands(env),
+            'requirements': get_requirements_file(env)}
+
+
+def plan_path(toxdir):
+    return os.path.join(toxdir, "ctox-plan.json")
+
+
+def plan_inputs(**kwargs):
+    """Everything other than files and environment variables which the plan
+    depends on, e.g. the posargs."""
+    from ctox.main import version
+    return dict(kwargs, version=version)
+
+
+def load_plan(toxdir, inputs):
+    """Returns the plan saved by save_plan, or None if it's out of date.
+
+    The plan is out of date if the inputs, the tox.ini or requirements files
+    or any environment variables used in them have changed.
+
+    """
+    from ctox.cache import read_json, files_unchanged
+    plan = read_json(plan_path(toxdir))
+    if (not plan or plan.get('inputs') != inputs or
+            plan['environ'] != _environ(plan['environ']) or
+            not files_unchanged(plan['files'])):
+        return None
+    return plan
+
+
+def save_plan(toxdir, inputs, toxinifile, plan):
+    from ctox.cache import file_stamp, write_json
+    paths = [toxinifile] + sorted(set(e['requirements']
+                                      for e in plan['envs'].values()
+                                      if e['requirements']))
+    keys = set()
+    for path in paths:
+        # Note: a missing tox.ini is read as empty (see read_config).
+        if os.path.isfile(path):
+            with open(path) as f:
+                keys.update(re.findall(r"{\s*env:([^:{}]+)", f.read()))
+    plan = dict(plan, inputs=inputs, environ=_environ(keys),
+                files=dict((path, file_stamp(path)) for path in paths))
+    write_json(plan_path(toxdir), plan)
+
+
+def _environ(keys):
+    return dict((k, os.environ.get(k)) for k in keys)
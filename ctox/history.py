@@ -0,0 +1,170 @@
+"""This module contains the history of previous runs, stored in the toxdir.
+
+At the moment this is the time spent in each phase (create, installdeps,
+cache, inst and runtests) of each env, which is used to schedule the slowest
+envs first when running in parallel, and the outcome of each env, which is
+used by --failed-first and --only-failed.
+
+"""
+
+import os
+
+PHASES = ('create', 'installdeps', 'cache', 'inst', 'runtests')
+
+
+def history_path(toxdir):
+    return os.path.join(toxdir, "ctox-history.json")
+
+
+def read_history(toxdir):
+    """Returns a dict of env name to a dict of phase to seconds."""
+    from ctox.cache import read_json
+    return read_json(history_path(toxdir), {})
+
+
+def record_history(toxdir, durations):
+    """Update the history with the durations (a dict of env name to a dict of
+    phase to seconds) of this run."""
+    from ctox.cache import write_json
+    history = read_history(toxdir)
+    history.update(durations)
+    write_json(history_path(toxdir), history)
+
+
+def outcomes_path(toxdir):
+    return os.path.join(toxdir, "ctox-outcomes.json")
+
+
+def read_outcomes(toxdir):
+    """Returns a dict of env name to its last outcome (see Env.ctox)."""
+    from ctox.cache import read_json
+    return read_json(outcomes_path(toxdir), {})
+
+
+def record_outcomes(toxdir, failing):
+    """Update the outcomes with those (a dict of env name to outcome) of this
+    run."""
+    from ctox.cache import write_json
+    outcomes = read_outcomes(toxdir)
+    outcomes.update((e, int(n)) for e, n in failing.items())
+    write_json(outcomes_path(toxdir), outcomes)
+
+
+def failed_first(envlist, outcomes):
+    """Move the envs which failed last time to the front of envlist.
+
+    Example
+    -------
+    >>> failed_first(["a", "b", "c"], {"a": 0, "b": 1})
+    ['b', 'a', 'c']
+
+    """
+    return sorted(envlist, key=lambda e: outcomes.get(e) != 1)
+
+
+def only_failed(envlist, outcomes):
+    """The envs of envlist which failed last time."""
+    return [e for e in envlist if outcomes.get(e) == 1]
+
+
+def expected_duration(history, env_name):
+    """The total seconds env_name took last time, or None if unknown."""
+    if env_name in history:
+        return sum(history[env_name].values())
+
+
+def longest_first(envlist, history):
+    """Sort envlist by expected duration, slowest first.
+
+    Envs without a history are expected to take the mean of those with one.
+
+    Example
+    -------
+    >>> longest_first(["a", "b", "c"], {"a": {"runtests": 1},
+    ...                                 "b": {"runtests": 5}})
+    ['b', 'c', 'a']
+
+    """
+    known = [expected_duration(history, e) for e in envlist
+             if e in history]
+    mean = sum(known) / len(known) if known else 0
+
+    def expected(env_name):
+        d = expected_duration(history, env_name)
+        return mean if d is None else d
+    return sorted(envlist, key=expected, reverse=True)
+
+
+def format_duration(seconds):
+    if seconds < 60:
+        return "%.1fs" % seconds
+    return "%dm%02ds" % divmod(int(round(seconds)), 60)
+
+
+def shard(envlist, index, count, history):
+    """The envs of envlist which the index-th of count shards should run
+    (index is 1-based), preserving the order of envlist.
+
+    If there is a history of any of the envs the shards are balanced by
+    expected duration (by greedily giving the slowest remaining env to the
+    shard with least to do), otherwise envs are dealt out round-robin.
+    Each shard must see the same envlist and history.
+
+    Example
+    -------
+    >>> shard(["a", "b", "c", "d"], 1, 2, {})
+    ['a', 'c']
+    >>> shard(["a", "b", "c", "d"], 1, 2, {"a": {"runtests": 10},
+    ...                                    "b": {"runtests": 1},
+    ...                                    "c": {"runtests": 2},
+    ...                                    "d": {"runtests": 3}})
+    ['a']
+
+    """
+    if not any(e in history for e in envlist):
+        return envlist[index - 1::count]
+
+    known = [expected_duration(history, e) for e in envlist
+             if e in history]
+    mean = sum(known) / len(known)
+    loads = [0] * count
+    mine = set()
+    for env_name in longest_first(envlist, history):
+        d = expected_duration(history, env_name)
+        i = loads.index(min(loads))
+        loads[i] += mean if d is None else d
+        if i == index - 1:
+            mine.add(env_name)
+    return [e for e in envlist if e in mine]
+
+
+def write_summary(path, envlist, failing, durations):
+    """Write the outcome (see Env.ctox) and durations of each env to path as
+    json, these can be combined with merge_summaries."""
+    from ctox.cache import write_json
+    envs = dict((e, {'outcome': int(failing[e]),
+                     'durations': durations.get(e, {})})
+                for e in envlist)
+    write_json(path, {'envlist': envlist, 'envs': envs})
+
+
+def merge_summaries(paths):
+    """Read the summaries written by write_summary to each of paths.
+
+    Returns a tuple of the envlist, dict of env_name to outcome and dict of
+    env_name to durations.
+
+    """
+    from ctox.cache import read_json
+    envlist, failing, durations = [], {}, {}
+    for path in paths:
+        summary = read_json(path, None)
+        if summary is None:
+            raise IOError("Unable to read summary %s" % path)
+        for env_name in summary['envlist']:
+            if env_name not in failing:
+                envlist.append(env_name)
+            env = summary['envs'][env_name]
+            failing[env_name] = env['outcome']
+            durations[env_name] = env['durations']
+    return envlist, failing, durations
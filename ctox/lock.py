@@ -0,0 +1,85 @@
+"""This module contains advisory file locks, so that several ctox processes
+(e.g. two runs in the same checkout, or CI jobs sharing a cache dir) don't
+create the same env, sdist or cache entry at once.
+
+Each lock is a file next to the thing it protects, e.g. foo.lock for foo.
+Whoever gets the lock second should re-check whether the first has already
+done the work (and reuse it) rather than repeating it.
+
+"""
+
+from contextlib import contextmanager
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows, pragma: no cover
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
+@contextmanager
+def file_lock(path, wait=None):
+    """Hold an exclusive lock on path (the file path + ".lock") in this block,
+    waiting until any other process has released it.
+
+    wait is called (once) if the lock is held by another process, e.g. to
+    print that we're waiting.
+
+    Note: where neither fcntl nor msvcrt is available this doesn't lock.
+
+    """
+    lockfile = path.rstrip(os.sep) + ".lock"
+    d = os.path.dirname(lockfile)
+    if d and not os.path.isdir(d):
+        try:
+            os.makedirs(d)
+        except OSError:  # pragma: no cover
+            # Created concurrently.
+            pass
+    f = open(lockfile, 'a+')
+    try:
+        if not _try_lock(f):
+            if wait is not None:
+                wait()
+            _lock(f)
+        try:
+            yield
+        finally:
+            _unlock(f)
+    finally:
+        f.close()
+
+
+def _try_lock(f):
+    """Try to lock f without blocking, returns whether that worked."""
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        elif msvcrt is not None:  # pragma: no cover
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _lock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    elif msvcrt is not None:  # pragma: no cover
+        # Note: LK_LOCK only retries for 10 seconds, so keep trying.
+        while not _try_lock(f):
+            time.sleep(0.1)
+
+
+def _unlock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    elif msvcrt is not None:  # pragma: no cover
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
@@ -5,7 +5,11 @@ The Env class create the environment specific methods.
 """
 
 import os
-from ctox.shell import check_output, CalledProcessError  # TODO remove?
+import sys
+import time
+from contextlib import contextmanager
+from timeit import default_timer as timer
+from ctox.shell import CalledProcessError
 
 from ctox.shell import cprint
 
@@ -18,14 +22,24 @@ class Env(object):
 
     """A conda environment."""
 
+    # If True the output of commands is read through a pipe, logged (to
+    # envlogdir) and printed through sys.stdout, rather than going straight
+    # to the terminal (which is needed for e.g. --pdb).
+    buffered = False
+
+    # The seconds spent in each phase, see Env.timed.
+    durations = None
+
     # TODO it's tempting to remove all but the tox variables as attributes
     # i.e. call out to pkg or config functions rather than dummy methods,
     # make the config and options private and have Env.ctox a function again.
     # This would makes the _replace_match substitution a little cleaner.
 
-    def __init__(self, name, config, options, toxdir, toxinidir, package):
+    def __init__(self, name, config, options, toxdir, toxinidir, package,
+                 args=None, plan=None):
         self.config = config
         self.options = options
+        self.args = args
         self.name = name
 
         self.toxdir = toxdir
@@ -34,7 +48,22 @@ class Env(object):
         self.distdir = os.path.join(self.toxdir, "dist")
         self.envdistdir = os.path.join(self.envdir, "dist")
         self.envctoxfile = os.path.join(self.envdir, "ctox")
+        self.envdistfile = os.path.join(self.envdir, "ctox-dist")
+        self.envlockfile = os.path.join(self.envdir, "ctox.lock")
+        self.envresultsfile = os.path.join(self.envdir, "ctox-results.json")
+        self.envpassedfile = os.path.join(self.envdir, "ctox-passed")
         self.envbindir = os.path.join(self.envdir, "bin")
+        # Note: this isn't in envdir, as that's removed when it's recreated.
+        self.envlogdir = os.path.join(toxdir, "log", self.name)
+        self.cachedir = os.path.abspath(getattr(args, 'cache_dir', None) or
+                                        os.path.join(self.toxdir, ".cache"))
+        self.base_envs = bool(getattr(args, 'base_envs', False))
+        self.force_reinstall = bool(getattr(args, 'force_reinstall', False))
+
+        from ctox.pkg import get_backend
+        from ctox.config import get_backend_name
+        self.backend = get_backend(getattr(args, 'backend', None) or
+                                   get_backend_name(config))
 
         self.conda = os.path.join(self.envbindir, "conda")
         self.pip = os.path.join(self.envbindir, "pip")
@@ -52,13 +81,21 @@ class Env(object):
                                            self.package + ".zip")
         self.envpackagedir = os.path.join(self.envdistdir, package)
 
-        from ctox.config import (
-            get_commands, get_deps, get_whitelist, get_changedir)
-        self.changedir = get_changedir(self)
+        if plan is None:
+            from ctox.config import env_plan
+            plan = env_plan(self)
         # TODO remove these as attributes and call them directly
-        self.whitelist = get_whitelist(self.config)
-        self.deps = get_deps(self)
-        self.commands = get_commands(self)
+        self.changedir = plan['changedir']
+        self.whitelist = plan['whitelist']
+        self.deps = plan['deps']
+        self.commands = plan['commands']
+        self.requirements = plan['requirements']
+
+    def plan(self):
+        """The resolved config of this env, see config.env_plan."""
+        return {'changedir': self.changedir, 'whitelist': self.whitelist,
+                'deps': self.deps, 'commands': self.commands,
+                'requirements': self.requirements}
 
     def ctox(self):
         """Main method for the environment.
@@ -70,6 +107,39 @@ class Env(object):
         (either in setup or whilst running the commands), 2 if the build
         was skipped.
 
+        """
+        return self.setup() or self.runtests()
+
+    @contextmanager
+    def timed(self, phase):
+        """Add the time spent in the block to durations[phase] (and record
+        it as a span, see ctox.trace)."""
+        from ctox.trace import span
+        if self.durations is None:
+            self.durations = {}
+        start = timer()
+        try:
+            with span(phase, cat='phase', env=self.name):
+                yield
+        finally:
+            self.durations[phase] = (self.durations.get(phase, 0) +
+                                     timer() - start)
+
+    def locked(self):
+        """Lock the env (against other ctox processes) for the block."""
+        from ctox.lock import file_lock
+
+        def wait():
+            cprint("%s waiting for another ctox process using %s"
+                   % (self.name, self.envdir), 'warn')
+        return file_lock(self.envdir, wait=wait)
+
+    def setup(self):
+        """Create the env, install the dependancies and the project.
+
+        Returns 0 if the env is ready to run the commands, 1 if there was an
+        error and 2 if the build was skipped.
+
         """
         # TODO make this less of a hack e.g. using basepython from config
         # if it exists (and use an attribute directly).
@@ -80,17 +150,30 @@ class Env(object):
                    'warn')
             return 2
 
-        # TODO don't remove env if there's a dependancy mis-match
-        # rather "clean" it to the empty state (the hope being to keep
-        # the dist build around - so not all files need to be rebuilt)
-        # TODO extract this as a method (for readability)
-        if not self.env_exists() or self.reusableable():
-            cprint("%s create: %s" % (self.name, self.envdir))
-            self.create_env(force_remove=True)
-
-            cprint("%s installdeps: %s" % (self.name, ', '.join(self.deps)))
-            if not self.install_deps():
-                cprint("    deps installation failed, aborted.\n", 'err')
+        # Note: the output of conda, pip etc. is only logged, if something
+        # fails the tail of its output is printed.
+        from ctox.shell import log_to, print_failure
+        with self.locked():
+            with log_to(os.path.join(self.envlogdir, "setup.log")):
+                # Note: if another process held the lock it may have already
+                # done the work, prepare checks for (and reuses) that.
+                ready = self.prepare()
+                if ready != 0:
+                    print_failure()
+                return ready
+
+    def prepare(self):
+        """Create (or reuse) the env and install the dependancies and the
+        project, returns 0 if that went ok."""
+        if not self.env_exists():
+            if not self.build_env():
+                return 1
+        elif self.reusableable():
+            # Try to only install (and remove) the deps which have changed,
+            # if that's not possible rebuild the env from scratch.
+            with self.timed('installdeps'):
+                updated = self.update_deps()
+            if not updated and not self.build_env():
                 return 1
         else:
             cprint("%s cached (deps unchanged): %s" % (self.name, self.envdir))
@@ -102,15 +185,82 @@ class Env(object):
         # if there are build files (e.g. cython) then tests must run where
         # the build was. Also, reinstalling should not overwrite the builds
         # e.g. setup.py will skip rebuilding cython files if they are unchanged
-        cprint("%s inst: %s" % (self.name, self.envdistdir))
-        if not self.install_dist():
-            cprint("    install failed.\n", 'err')
-            return 1
+        if not self.force_reinstall and self.dist_installed():
+            cprint("%s inst (unchanged): %s" % (self.name, self.envdistdir))
+        else:
+            cprint("%s inst: %s" % (self.name, self.envdistdir))
+            with self.timed('inst'):
+                installed = self.install_dist()
+            if not installed:
+                cprint("    install failed.\n", 'err')
+                return 1
+        return 0
 
-        cprint("%s runtests" % self.name)
-        # return False if all commands were successfully run
-        # otherwise returns True if at least one command exited badly
-        return self.run_commands()
+    def runtests(self):
+        """Run the commands (in an env which has been setup).
+
+        Returns 3 (without running them) if the result cache is enabled and
+        nothing has changed since they last succeeded.
+
+        """
+        from ctox.cache import result_key, passed_before, mark_passed
+        from ctox.shell import log_to
+        with self.locked():
+            key = None
+            if getattr(self.args, 'result_cache', False):
+                key = result_key(self, self.args.source_fingerprint)
+                if passed_before(self, key):
+                    cprint("%s runtests (cached ok)" % self.name, 'ok')
+                    return 3
+
+            cprint("%s runtests" % self.name)
+            # return False if all commands were successfully run
+            # otherwise returns True if at least one command exited badly
+            with self.timed('runtests'):
+                with log_to(os.path.join(self.envlogdir, "runtests.log")):
+                    failing = self.run_commands()
+            mark_passed(self, None if failing else key)
+            return failing
+
+    def build_env(self):
+        """(Re)create the env, either by cloning an env with the same deps
+        from the cache or by creating it and installing the deps.
+
+        Returns False if the deps failed to install.
+
+        """
+        cached = self.cached_env()
+        if cached:
+            cprint("%s create (cached deps): %s" % (self.name, cached))
+            with self.timed('create'):
+                self.create_env_from_cache(cached)
+            return True
+
+        lock = self.cached_lock()
+        if lock:
+            cprint("%s create (from lockfile): %s" % (self.name, self.envdir))
+            with self.timed('create'):
+                created = self.create_env_from_lock(lock)
+            if created:
+                with self.timed('cache'):
+                    self.cache_env()
+                return True
+            cprint("    lockfile install failed, resolving deps.", 'warn')
+
+        cprint("%s create: %s" % (self.name, self.envdir))
+        with self.timed('create'):
+            self.create_env(force_remove=True)
+
+        cprint("%s installdeps: %s" % (self.name, ', '.join(self.deps)))
+        with self.timed('installdeps'):
+            installed = self.install_deps()
+        if not installed:
+            cprint("    deps installation failed, aborted.\n", 'err')
+            return False
+        with self.timed('cache'):
+            self.lock_env()
+            self.cache_env()
+        return True
 
     def prev_deps(self):
         from ctox.pkg import prev_deps
@@ -134,14 +284,21 @@ class Env(object):
         from ctox.pkg import install_dist
         return install_dist(self)
 
+    def dist_installed(self):
+        from ctox.pkg import dist_installed
+        return dist_installed(self)
+
     def install_deps(self):
         from ctox.pkg import install_deps
         return install_deps(self)
 
     def uninstall_deps(self, pdeps):
-        # from ctox.pkg import uninstall_deps
-        # return uninstall_deps(self, deps=pdeps)
-        self.create_env(force_remove=True)
+        from ctox.pkg import uninstall_deps
+        return uninstall_deps(self, deps=pdeps)
+
+    def update_deps(self):
+        from ctox.pkg import update_deps
+        return update_deps(self)
 
     def run_commands(self):
         from ctox.pkg import run_commands
@@ -151,9 +308,33 @@ class Env(object):
         from ctox.pkg import env_exists
         return env_exists(self)
 
-    def create_env(self, force_remove=False):
+    def create_env(self, force_remove=False, clone=None):
         from ctox.pkg import create_env
-        return create_env(self, force_remove=force_remove)
+        return create_env(self, force_remove=force_remove, clone=clone)
+
+    def lock_env(self):
+        from ctox.pkg import lock_env
+        return lock_env(self)
+
+    def cached_lock(self):
+        from ctox.pkg import cached_lock
+        return cached_lock(self)
+
+    def create_env_from_lock(self, lock):
+        from ctox.pkg import create_env_from_lock
+        return create_env_from_lock(self, lock)
+
+    def cached_env(self):
+        from ctox.pkg import cached_env
+        return cached_env(self)
+
+    def create_env_from_cache(self, cached):
+        from ctox.pkg import create_env_from_cache
+        return create_env_from_cache(self, cached)
+
+    def cache_env(self):
+        from ctox.pkg import cache_env
+        return cache_env(self)
 
 
 def main(arguments, toxinidir=None):
@@ -167,7 +348,6 @@ def main(arguments, toxinidir=None):
         pass
 
     try:
-        import sys
         sys.exit(ctox(arguments, toxinidir))
 
     except CalledProcessError as c:
@@ -188,6 +368,7 @@ def main(arguments, toxinidir=None):
 
 def parse_args(arguments):
     from argparse import ArgumentParser
+    from ctox.pkg import BACKENDS
     description = ("Tox but with conda.")
     epilog = ("")
     parser = ArgumentParser(description=description,
@@ -199,10 +380,85 @@ def parse_args(arguments):
     parser.add_argument('-e',
                         help='choose environments to run, comma seperated',
                         default='ALL')
+    parser.add_argument('-p', '--parallel',
+                        help='run up to N environments at once, '
+                             '0 to use one per cpu',
+                        type=int, default=1, metavar='N')
+    parser.add_argument('--setup-parallel',
+                        help='setup (create and install deps in) up to S '
+                             'environments at once, whilst others run their '
+                             'commands (default: same as --parallel)',
+                        type=int, metavar='S')
+    parser.add_argument('--cache-dir',
+                        help='directory of environments shared between '
+                             'tox envs with the same python version and '
+                             'deps (default: $CTOX_CACHE_DIR or .tox/.cache)',
+                        default=os.environ.get('CTOX_CACHE_DIR'))
+    parser.add_argument('--backend',
+                        help='conda, mamba or micromamba (default: the '
+                             '[ctox] backend option in tox.ini, or conda)',
+                        choices=sorted(BACKENDS))
+    parser.add_argument('--no-result-cache',
+                        help='run the commands even if the [ctox] '
+                             'result_cache option is set and nothing has '
+                             'changed since they last succeeded',
+                        action='store_true')
+    parser.add_argument('--force-reinstall',
+                        help='install the project (from the sdist, not '
+                             'the cached wheel) even if the same sdist is '
+                             'already installed in the env',
+                        action='store_true')
+    parser.add_argument('--base-envs',
+                        help='create envs by cloning a clean env for each '
+                             'python version (kept in the cache dir)',
+                        action='store_true')
+    parser.add_argument('--shard',
+                        help='only run the INDEX-th (from 1) of COUNT '
+                             'roughly equal parts of the envlist, balanced '
+                             'by the durations of previous runs',
+                        type=shard_arg, metavar='INDEX/COUNT')
+    parser.add_argument('--summary-json',
+                        help='write the outcome and duration of each env to '
+                             'FILE as json',
+                        metavar='FILE')
+    parser.add_argument('--failed-first',
+                        help='run the environments which failed last time '
+                             'first',
+                        action='store_true')
+    parser.add_argument('--only-failed',
+                        help='only run the environments which failed last '
+                             'time (or all of them, if none did)',
+                        action='store_true')
+    parser.add_argument('--timings',
+                        help='print how long each phase of each env, and '
+                             'each command run in it, took',
+                        action='store_true')
+    parser.add_argument('--trace',
+                        help='write the timings as a chrome trace to FILE '
+                             '(open it in chrome://tracing)',
+                        metavar='FILE')
+    parser.add_argument('--merge',
+                        help='print the combined summary of the json '
+                             'summaries of several runs (e.g. shards) '
+                             'instead of running anything',
+                        nargs='+', metavar='SUMMARY')
 
     return parser.parse_known_args(arguments)
 
 
+def shard_arg(s):
+    """Parse INDEX/COUNT into a tuple of ints, where 1 <= INDEX <= COUNT."""
+    from argparse import ArgumentTypeError
+    try:
+        index, count = map(int, s.split('/'))
+    except ValueError:
+        raise ArgumentTypeError("expected INDEX/COUNT e.g. 1/4, got %s" % s)
+    if not 1 <= index <= count:
+        raise ArgumentTypeError("INDEX must be between 1 and COUNT, got %s"
+                                % s)
+    return index, count
+
+
 def ctox(arguments, toxinidir):
     """Sets up conda environments, and sets up and runs each environment based
     on the project's tox.ini configuration file.
@@ -222,53 +478,346 @@ def ctox(arguments, toxinidir):
         print(version)
         return 0
 
-    # if no conda trigger OSError
-    try:
-        with open(os.devnull, "w") as fnull:
-            check_output(['conda', '--version'], stderr=fnull)
-    except OSError:
-        cprint("conda not found, you need to install it to use ctox.\n"
-               "The recommended way is to download miniconda,\n"
-               "Do not install conda via pip.", 'err')
-        return 1
-
     toxinifile = os.path.join(toxinidir, "tox.ini")
 
-    from ctox.config import read_config, get_envlist
-    config = read_config(toxinifile)
-    if args.e == 'ALL':
-        envlist = get_envlist(config)
-    else:
-        envlist = args.e.split(',')
-
     # TODO configure with option
     toxdir = os.path.join(toxinidir, ".tox")
 
-    # create a zip file for the project
-    from ctox.pkg import make_dist, package_name
-    cprint("GLOB sdist-make: %s" % os.path.join(toxinidir, "setup.py"))
-    package = package_name(toxinidir)
-    if not make_dist(toxinidir, toxdir, package):
-        cprint("    setup.py sdist failed", 'err')
+    if args.merge:
+        # Note: the merged durations become the history used to balance
+        # shards, so the shards of the next run can be given this .tox.
+        from ctox.history import merge_summaries, write_summary
+        from ctox.history import record_history
+        try:
+            envlist, failing, durations = merge_summaries(args.merge)
+        except IOError as e:
+            cprint(str(e), 'err')
+            return 1
+        record_history(toxdir, durations)
+        if args.summary_json:
+            write_summary(args.summary_json, envlist, failing, durations)
+        print_summary(envlist, failing, durations)
+        return any(1 == v for v in failing.values())
+
+    # create a zip file for the project (unless the project is unchanged)
+    from ctox.pkg import make_dist, package_name, cached_dist, save_dist_state
+    from ctox.trace import span
+    from ctox.lock import file_lock
+    # Note: the lock stops concurrent ctox runs building the sdist at once,
+    # whoever waited will find it's unchanged.
+    with span('sdist', cat='phase'):
+        with file_lock(os.path.join(toxdir, "dist")):
+            package, dist_state = cached_dist(toxinidir, toxdir)
+            if package:
+                cprint("GLOB sdist-make (unchanged): %s"
+                       % os.path.join(toxdir, "dist", package + ".zip"))
+            else:
+                cprint("GLOB sdist-make: %s"
+                       % os.path.join(toxinidir, "setup.py"))
+                package = package_name(toxinidir)
+                from ctox.shell import log_to, print_failure
+                with log_to(os.path.join(toxdir, "log", "GLOB", "sdist.log")):
+                    if not make_dist(toxinidir, toxdir, package):
+                        cprint("    setup.py sdist failed", 'err')
+                        print_failure()
+                        return 1
+                dist_state = save_dist_state(toxinidir, toxdir, dist_state,
+                                             package)
+
+    # resolve the deps, commands etc. of each env (unless nothing changed)
+    from ctox.config import load_plan, save_plan, plan_inputs
+    inputs = plan_inputs(toxinidir=toxinidir, toxdir=toxdir,
+                         package=package, options=options, envs=args.e,
+                         backend=args.backend)
+    with span('plan', cat='phase'):
+        plan = load_plan(toxdir, inputs)
+        if plan is None:
+            plan = make_plan(toxinifile, args=args, options=options,
+                             toxdir=toxdir, toxinidir=toxinidir,
+                             package=package)
+            if plan is None:
+                return 1
+            save_plan(toxdir, inputs, toxinifile, plan)
+    envlist = plan['envlist']
+
+    from ctox.history import read_history, record_history, longest_first
+    history = read_history(toxdir)
+    if args.shard:
+        from ctox.history import shard
+        index, count = args.shard
+        envlist = shard(envlist, index, count, history)
+        cprint("GLOB shard %s/%s: %s"
+               % (index, count, ', '.join(envlist) or '(no envs)'))
+
+    if args.only_failed or args.failed_first:
+        from ctox.history import read_outcomes, failed_first, only_failed
+        outcomes = read_outcomes(toxdir)
+        if args.only_failed:
+            if only_failed(envlist, outcomes):
+                envlist = only_failed(envlist, outcomes)
+            else:
+                cprint("GLOB no envs failed last time, running them all",
+                       'warn')
+        envlist = failed_first(envlist, outcomes)
+
+    # Note: the source fingerprint is what the sdist is checked against.
+    args.result_cache = (plan.get('result_cache', False) and
+                         not args.no_result_cache)
+    args.source_fingerprint = dist_state['fingerprint']
+
+    from ctox.pkg import get_backend
+    args.backend = args.backend or plan['backend']
+    backend = get_backend(args.backend)
+    if not backend.available():
+        cprint("%s not found, you need to install it to use ctox.\n"
+               "The recommended way is to download miniconda,\n"
+               "Do not install conda via pip." % backend.exe, 'err')
         return 1
 
     # setup each environment and run ctox
-    failing = {}
-    for env_name in envlist:
-        env = Env(name=env_name, config=config, options=options,
-                  toxdir=toxdir, toxinidir=toxinidir, package=package)
-        failing[env_name] = env.ctox()
+    failing, durations = {}, {}
+    setup_parallel = (args.parallel if args.setup_parallel is None
+                      else args.setup_parallel)
+    if (args.parallel == 1 and setup_parallel == 1) or len(envlist) < 2:
+        for env_name in envlist:
+            env = Env(name=env_name, config=None, options=options,
+                      toxdir=toxdir, toxinidir=toxinidir, package=package,
+                      args=args, plan=plan['envs'][env_name])
+            failing[env_name] = env.ctox()
+            durations[env_name] = env.durations or {}
+    else:
+        # start the slowest envs first, so they don't hold up the end.
+        schedule = longest_first(envlist, history)
+        if args.only_failed or args.failed_first:
+            schedule = failed_first(schedule, outcomes)
+        started = time.time()
+        failing, durations = run_parallel(
+            schedule, args.parallel, setup_parallel, plan=plan['envs'],
+            options=options, toxdir=toxdir, toxinidir=toxinidir,
+            package=package, args=args)
+        replay_logs(envlist, failing, toxdir, since=started)
+    if not args.shard:
+        # Each shard must see the same history to agree on the split, so
+        # this is left to --merge.
+        record_history(toxdir, durations)
+
+    from ctox.history import record_outcomes
+    record_outcomes(toxdir, failing)
+
+    if args.summary_json:
+        from ctox.history import write_summary
+        write_summary(args.summary_json, envlist, failing, durations)
+    print_summary(envlist, failing, durations)
+
+    from ctox.trace import spans, print_timings, write_trace
+    if args.timings:
+        print_timings(envlist, spans())
+    if args.trace:
+        write_trace(args.trace, envlist, spans())
+
+    return any(1 == v for v in failing.values())
 
-    # print summary of the outcomes of ctox for each environment
+
+def print_summary(envlist, failing, durations):
+    "Print the outcome of ctox for each environment, and how long it took."
+    from ctox.history import format_duration
     cprint('Summary')
     print("-" * 23)
     for env_name in envlist:
         n = failing[env_name]
-        outcome = ('succeeded', 'failed', 'skipped')[n]
-        status = ('ok', 'err', 'warn')[n]
-        cprint("%s commands %s" % (env_name, outcome), status)
+        outcome = ('succeeded', 'failed', 'skipped', 'cached ok')[n]
+        status = ('ok', 'err', 'warn', 'ok')[n]
+        took = sum(durations.get(env_name, {}).values())
+        cprint("%s commands %s (%s)"
+               % (env_name, outcome, format_duration(took)), status)
 
-    return any(1 == v for v in failing.values())
+
+def make_plan(toxinifile, args, **kwargs):
+    """Parse the tox.ini and resolve the deps, commands, changedir and
+    whitelist of each env (see config.env_plan).
+
+    Returns None if the tox.ini's [ctox] backend isn't supported.
+
+    """
+    from ctox.config import (read_config, get_envlist, get_backend_name,
+                             get_result_cache)
+    from ctox.subst import parse_envlist
+    config = read_config(toxinifile)
+    if args.e == 'ALL':
+        envlist = get_envlist(config)
+    else:
+        # Note: this can also use the envlist syntax e.g. py{27,34}-django.
+        envlist = parse_envlist(args.e)
+
+    from ctox.pkg import BACKENDS
+    backend = args.backend or get_backend_name(config)
+    if backend not in BACKENDS:
+        cprint("Unknown backend %s, expected one of %s."
+               % (backend, ', '.join(sorted(BACKENDS))), 'err')
+        return None
+
+    from argparse import Namespace
+    env_args = Namespace(**dict(vars(args), backend=backend))
+    envs = dict((env_name, Env(name=env_name, config=config, args=env_args,
+                               **kwargs).plan())
+                for env_name in envlist)
+    return {'envlist': envlist, 'backend': backend,
+            'result_cache': get_result_cache(config), 'envs': envs}
+
+
+def run_parallel(envlist, processes, setup_processes, plan, **kwargs):
+    """Run ctox for each environment in envlist in two pipelined pools of
+    processes.
+
+    Envs are setup (created and deps and the project installed) in a pool of
+    setup_processes and, once that's done, their commands run in a pool of
+    processes. So envs are being setup whilst others run their commands.
+
+    Each line of output is printed as it happens, prefixed with the env's
+    name, see _ctox_env. Returns a tuple of dicts of env_name to outcome (see
+    Env.ctox) and env_name to durations (see Env.timed).
+
+    """
+    from multiprocessing import Pool
+    from ctox.trace import add_spans
+    try:
+        from multiprocessing import SimpleQueue
+    except ImportError:  # py2, pragma: no cover
+        from multiprocessing.queues import SimpleQueue
+
+    jobs = {}
+    for env_name in envlist:
+        jobs[env_name] = dict(kwargs, name=env_name, plan=plan[env_name])
+
+    # Workers put (env name, stage, pid) on started as they start a job, so
+    # we can tell if the worker running an env dies (its result never comes).
+    # Note: not a Queue, whose puts are sent by a thread, so can be lost if
+    # the worker dies.
+    started = SimpleQueue()
+    setup_pool = Pool(setup_processes or None, _init_worker, (started,))
+    test_pool = Pool(processes or None, _init_worker, (started,))
+    # env name -> (stage, AsyncResult) and env name -> pid of its worker.
+    pending, pids = {}, {}
+    failing, durations = {}, {}
+    try:
+        for env_name in envlist:
+            pending[env_name] = ('setup', setup_pool.apply_async(
+                _ctox_env, ('setup', jobs[env_name])))
+
+        while pending:
+            while not started.empty():
+                env_name, stage, pid = started.get()
+                if pending.get(env_name, (None,))[0] == stage:
+                    pids[env_name] = pid
+
+            ready = [e for e in pending if pending[e][1].ready()]
+            for env_name in ready:
+                _, res = pending.pop(env_name)
+                pids.pop(env_name, None)
+                try:
+                    stage, _, outcome, took, spans, error = res.get()
+                except Exception as e:
+                    # e.g. the result couldn't be pickled.
+                    cprint("%s was lost: %s" % (env_name, e), 'err')
+                    failing[env_name] = 1
+                    durations.setdefault(env_name, {})
+                    continue
+                if error is not None:
+                    raise error
+                durations.setdefault(env_name, {}).update(took)
+                add_spans(spans)
+                if stage == 'setup' and outcome == 0:
+                    pending[env_name] = ('runtests', test_pool.apply_async(
+                        _ctox_env, ('runtests', jobs[env_name])))
+                else:
+                    failing[env_name] = outcome
+
+            for env_name in list(pending):
+                if (env_name in pids and not _alive(pids[env_name]) and
+                        not pending[env_name][1].ready()):
+                    cprint("%s was lost: its worker died" % env_name, 'err')
+                    del pending[env_name]
+                    failing[env_name] = 1
+                    durations.setdefault(env_name, {})
+
+            if not ready:
+                time.sleep(0.05)
+    finally:
+        setup_pool.terminate()
+        test_pool.terminate()
+    return failing, durations
+
+
+_started = None
+
+
+def _init_worker(started):
+    """Pool initializer: keep the queue to announce jobs on in _ctox_env."""
+    global _started
+    _started = started
+
+
+def _announce(env_name, stage):
+    """Tell run_parallel which worker is running stage of env_name."""
+    if _started is not None:
+        _started.put((env_name, stage, os.getpid()))
+
+
+def _alive(pid):
+    """Whether the process pid is running."""
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _ctox_env(stage, kwargs):
+    """Pool worker: create the Env and run stage (setup or runtests),
+    printing its output prefixed with [env name].
+
+    Returns a tuple of stage, env name, outcome, the durations of each phase,
+    the spans recorded (see ctox.trace) and the exception raised (if any).
+
+    """
+    from ctox.shell import prefixed_output
+    from ctox import trace
+    _announce(kwargs['name'], stage)
+    # Forget any spans inherited from the parent or a previous job.
+    trace.reset()
+    error = env = None
+    with prefixed_output("[%s] " % kwargs['name']):
+        try:
+            env = Env(config=None, **kwargs)
+            env.buffered = True
+            outcome = getattr(env, stage)()
+        except Exception as e:
+            outcome, error = 1, e
+    took = (env and env.durations) or {}
+    return stage, kwargs['name'], outcome, took, trace.spans(), error
+
+
+def replay_logs(envlist, failing, toxdir, since):
+    """Print the full log of the stage (setup or runtests) which failed of
+    each env which failed, in envlist order.
+
+    Logs older than the time since (i.e. from previous runs) are ignored.
+
+    """
+    for env_name in envlist:
+        if failing[env_name] != 1:
+            continue
+        for log in ("runtests.log", "setup.log"):
+            path = os.path.join(toxdir, "log", env_name, log)
+            if os.path.exists(path) and os.path.getmtime(path) >= since:
+                break
+        else:
+            continue
+        cprint("%s %s: %s" % (env_name, log, path), 'err')
+        with open(path) as f:
+            for line in f:
+                sys.stdout.write(line)
+        sys.stdout.flush()
 
 
 def positional_args(arguments):
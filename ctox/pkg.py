@@ -1,38 +1,307 @@
 """This module contains methods for installing and removing packages.
 
-These are mostly lightweight wrappers shelling out to the conda and then
-env.pip. Note that throughout this module the env variable is understood
-to be a ctox.main.Env instance.
+These are mostly lightweight wrappers shelling out to the conda (via the
+env's backend, see CondaBackend) and then env.pip. Note that throughout this
+module the env variable is understood to be a ctox.main.Env instance.
 
 """
 
+import json
 import os
+import sys
 
-from subprocess import Popen, STDOUT
-from ctox.shell import safe_shell_out, CalledProcessError, shell_out, cprint
+from subprocess import Popen, PIPE, STDOUT
+from ctox.shell import (safe_shell_out, CalledProcessError, check_output,
+                        shell_out, cprint, _clean_output, stream_lines,
+                        log_command)
+from ctox.trace import span, command_name
+
+
+class CondaBackend(object):
+
+    """Environment operations, shelling out to conda.
+
+    Note: prefix can be relative to cwd (as env.name is to env.toxdir).
+    Methods which return a bool suppress output and errors, the others
+    raise CalledProcessError.
+
+    """
+
+    exe = 'conda'
+
+    def available(self):
+        try:
+            with open(os.devnull, "w") as fnull:
+                check_output([self.exe, '--version'], stderr=fnull)
+            return True
+        except (OSError, CalledProcessError):
+            return False
+
+    def exists(self, path):
+        return os.path.isdir(os.path.join(path, "conda-meta"))
+
+    def create(self, prefix, py_version, cwd):
+        shell_out([self.exe, 'create', '-p', prefix,
+                   'python=%s' % py_version, '--yes', '--quiet'], cwd=cwd)
+
+    def clone(self, prefix, source, cwd):
+        shell_out([self.exe, 'create', '-p', prefix, '--clone', source,
+                   '--yes', '--quiet'], cwd=cwd)
+
+    def create_explicit(self, prefix, explicit, cwd):
+        """Create from an explicit spec file, see list_explicit."""
+        return safe_shell_out([self.exe, 'create', '-p', prefix,
+                               '--file', explicit, '--yes', '--quiet'],
+                              cwd=cwd)
+
+    def remove_env(self, prefix, cwd):
+        path = os.path.join(cwd, prefix)
+        if self.exists(path):
+            shell_out([self.exe, 'remove', '-p', prefix, '--all',
+                       '--yes', '--quiet'], cwd=cwd)
+        elif os.path.isdir(path):
+            # Not an env (e.g. a half-finished create), conda won't remove it.
+            from shutil import rmtree
+            rmtree(path)
+
+    def install(self, prefix, libs, cwd):
+        return safe_shell_out([self.exe, "install"] + _conda_specs(libs) +
+                              ["-p", prefix, "--yes", "--quiet"], cwd=cwd)
+
+    def remove(self, prefix, libs, cwd):
+        return safe_shell_out([self.exe, "remove"] + _conda_specs(libs) +
+                              ["-p", prefix, "--yes", "--quiet"], cwd=cwd)
+
+    def not_found(self, prefix, libs, cwd):
+        """Dry-run installing libs, returns the libs which can't be found.
+
+        Returns None if the solve failed for some other reason.
+
+        """
+        from ctox.cache import dep_name
+        try:
+            cmd = ([self.exe, "install"] + _conda_specs(libs) +
+                   ["-p", prefix, "--dry-run", "--json", "--yes"])
+            with open(os.devnull, "w") as fnull:
+                with span(command_name(cmd), cmd=' '.join(cmd)):
+                    check_output(cmd, stderr=fnull, cwd=cwd)
+            return []
+        except CalledProcessError as e:
+            try:
+                err = json.loads(_clean_output(e.output))
+            except ValueError:
+                return None
+            if err.get('exception_name') != 'PackagesNotFoundError':
+                return None
+            names = set(dep_name(p) for p in err.get('packages', []))
+            return [lib for lib in libs if dep_name(lib) in names] or None
+        except OSError:
+            return None
+
+    def would_remove(self, prefix, libs, cwd):
+        """Dry-run removing libs, returns the names of the packages which
+        would be removed (which includes those depending on libs).
+
+        Returns None if conda failed (e.g. libs weren't installed by conda).
+
+        """
+        from ctox.cache import dep_name
+        cmd = ([self.exe, "remove"] + _conda_specs(libs) +
+               ["-p", prefix, "--dry-run", "--json", "--yes"])
+        try:
+            with open(os.devnull, "w") as fnull:
+                with span(command_name(cmd), cmd=' '.join(cmd)):
+                    out = json.loads(_clean_output(
+                        check_output(cmd, stderr=fnull, cwd=cwd)))
+        except (OSError, CalledProcessError, ValueError):
+            return None
+        unlink = out.get('actions', {}).get('UNLINK', [])
+        # Note: older condas list dists e.g. "numpy-1.9.2-py34_0".
+        return [dep_name(p['name'] if isinstance(p, dict)
+                         else p.rsplit('-', 2)[0])
+                for p in unlink]
+
+    def list_explicit(self, prefix, cwd):
+        """The exact (url) specs of the installed packages."""
+        return shell_out([self.exe, "list", "-p", prefix, "--explicit"],
+                         cwd=cwd)
+
+
+class MambaBackend(CondaBackend):
+
+    """mamba has the same cli as conda, but a much faster solver."""
+
+    exe = 'mamba'
+
+
+class MicromambaBackend(CondaBackend):
+
+    """micromamba (standalone mamba) doesn't support cloning or removing an
+    env with remove --all."""
+
+    exe = 'micromamba'
+
+    def clone(self, prefix, source, cwd):
+        """Create prefix from the explicit specs of source, and then pip
+        install what was pip installed in source (which the specs don't
+        include)."""
+        name = os.path.basename(prefix.rstrip(os.sep))
+        explicit = os.path.join(cwd, "%s-clone.txt" % name)
+        frozen = os.path.join(cwd, "%s-clone-frozen.txt" % name)
+        reqs = []
+        source_pip = os.path.join(cwd, source, "bin", "pip")
+        if os.path.exists(source_pip):
+            reqs = pip_requirements(shell_out([source_pip, "freeze"],
+                                              cwd=cwd))
+        with open(explicit, 'w') as f:
+            f.write(self.list_explicit(source, cwd) + "\n")
+        with open(frozen, 'w') as f:
+            f.write("\n".join(reqs) + "\n")
+        try:
+            if not self.create_explicit(prefix, explicit, cwd):
+                raise CalledProcessError(1, [self.exe, 'create', '-p', prefix,
+                                             '--file', explicit])
+            pip = os.path.join(cwd, prefix, "bin", "pip")
+            cmd = [pip, 'install', '--no-deps', '--quiet', '-r', frozen]
+            if reqs and not safe_shell_out(cmd, cwd=cwd):
+                raise CalledProcessError(1, cmd)
+        finally:
+            os.remove(explicit)
+            os.remove(frozen)
+
+    def not_found(self, prefix, libs, cwd):
+        """As CondaBackend.not_found, but if micromamba's error can't be
+        parsed, dry-run each lib on its own: those which fail can't be found.
+
+        Returns None if each lib can be installed alone (so they conflict).
+
+        """
+        find = super(MicromambaBackend, self).not_found
+        missing = find(prefix, libs, cwd)
+        if missing is not None:
+            return missing
+        if len(libs) == 1:
+            return list(libs)
+        return [lib for lib in libs if find(prefix, [lib], cwd) != []] or None
+
+    def remove_env(self, prefix, cwd):
+        from shutil import rmtree
+        path = os.path.join(cwd, prefix)
+        if os.path.isdir(path):
+            rmtree(path)
+
+
+BACKENDS = {'conda': CondaBackend,
+            'mamba': MambaBackend,
+            'micromamba': MicromambaBackend}
+
+
+def get_backend(name):
+    """Returns the backend instance, raises KeyError if name isn't one of
+    BACKENDS."""
+    return BACKENDS[name or 'conda']()
+
+
+def _conda_specs(libs):
+    # obviously conda syntax is different
+    return [lib.replace('==', '=') for lib in libs]
 
 
 def env_exists(env):
-    return os.path.isdir(os.path.join(env.envdir, "conda-meta"))
+    return env.backend.exists(env.envdir)
+
+
+def create_env(env, force_remove=False, clone=None):
+    """Create the conda environment, if clone is passed it's cloned from that
+    path (which is much faster than solving and installing).
+
+    If env.base_envs is set, env is cloned from a clean env for its python
+    version which is shared between all envs.
 
+    """
+    if clone is None and env.base_envs:
+        clone = base_env(env)
 
-def create_env(env, force_remove=False):
-    # TODO cache cache cache!
-    # TODO potentially we could keep a clean env around for each basepython.
     if force_remove:
-        shell_out(['conda', 'remove', '-p', env.name, '--all',
-                   '--yes', '--quiet'],
-                  cwd=env.toxdir)
+        env.backend.remove_env(env.name, cwd=env.toxdir)
+
+    if clone:
+        from ctox.cache import CACHED_MARKER
+        env.backend.clone(env.name, clone, cwd=env.toxdir)
+        # The clone copies the marker, but env isn't in the cache (and if
+        # it were cloned into the cache a half-finished clone would be used).
+        marker = os.path.join(env.envdir, CACHED_MARKER)
+        if os.path.isfile(marker):
+            os.remove(marker)
+    else:
+        env.backend.create(env.name, env.py_version, cwd=env.toxdir)
+
+
+def base_env(env):
+    """Returns the path of the clean env for env's python version, creating
+    it if it doesn't exist."""
+    from ctox.cache import base_env_path, is_cached, mark_cached
+    from ctox.lock import file_lock
+    path = base_env_path(env)
+    if is_cached(path):
+        return path
+    with file_lock(path):
+        # Check it wasn't created by another process whilst we waited.
+        if not is_cached(path):
+            # Remove any previous create which didn't complete.
+            env.backend.remove_env(path, cwd=env.toxdir)
+            env.backend.create(path, env.py_version, cwd=env.toxdir)
+            mark_cached(path)
+    return path
+
+
+def cached_env(env):
+    """Returns the path to a cached env with the same deps, or None."""
+    from ctox.cache import cached_env_path, is_cached
+    path = cached_env_path(env)
+    if is_cached(path):
+        return path
+
+
+def create_env_from_cache(env, path):
+    """Create env by cloning the cached env at path (which has the same python
+    version and deps), and record its deps and lock."""
+    from ctox.cache import lock_path, read_json, write_json
+    create_env(env, force_remove=True, clone=path)
+    write_deps(env)
+    lock = read_json(lock_path(env))
+    if lock:
+        write_json(env.envlockfile, lock)
+    elif os.path.isfile(env.envlockfile):
+        # Don't leave a lockfile from whatever path was cloned from.
+        os.remove(env.envlockfile)
+
+
+def cache_env(env):
+    """Clone env (with its deps installed) into the env cache.
+
+    Note: conda clones are hardlinked where possible, so this is cheap.
 
-    shell_out(['conda', 'create', '-p', env.name,
-               'python=%s' % env.py_version, '--yes', '--quiet'],
-              cwd=env.toxdir)
+    """
+    from ctox.cache import cached_env_path, is_cached, mark_cached
+    from ctox.lock import file_lock
+    path = cached_env_path(env)
+    with file_lock(path):
+        if is_cached(path):
+            # Cached by another process (with the same deps).
+            return True
+        try:
+            # Remove any previous clone which didn't complete.
+            env.backend.remove_env(path, cwd=env.toxdir)
+            env.backend.clone(path, env.envdir, cwd=env.toxdir)
+        except (OSError, CalledProcessError):
+            return False
+        mark_cached(path)
+    return True
 
 
 def install(env, lib):
-    lib_ = lib.replace('==', '=')  # obviously conda syntax is different
-    success = (safe_shell_out(["conda", "install", lib_, "-p", env.name,
-                               "--yes", "--quiet"], cwd=env.toxdir) or
+    success = (env.backend.install(env.name, [lib], cwd=env.toxdir) or
                safe_shell_out([env.pip, "install",
                                "--quiet", lib], cwd=env.toxdir))
 
@@ -45,9 +314,7 @@ def install(env, lib):
 
 
 def uninstall(env, lib):
-    lib_ = lib.replace('==', '=')  # obviously conda syntax is different
-    success = (safe_shell_out(["conda", "remove", lib_, "-p", env.name,
-                               "--yes", "--quiet"], cwd=env.toxdir) or
+    success = (env.backend.remove(env.name, [lib], cwd=env.toxdir) or
                safe_shell_out([env.pip, "uninstall", lib,
                                "--yes", "--quiet"], cwd=env.toxdir))
     return success
@@ -56,29 +323,274 @@ def uninstall(env, lib):
 def install_deps(env):
     print("installing deps...")
     try:
-        # TODO can we do this in one pass?
+        split = split_deps(env, env.deps)
+        if split is not None:
+            if install_batch(env, *split):
+                return True
+            forget_deps(env, env.deps)
+        # Fall back to installing each of the deps one at a time.
         return all(install(env=env, lib=d) for d in env.deps)
-    except (OSError, CalledProcessError) as e:
-        import pdb
-        pdb.set_trace()
+    except (OSError, CalledProcessError):
+        return False
+
+
+def install_batch(env, conda_deps, pip_deps):
+    """Install all conda_deps in one conda transaction and then all pip_deps
+    in one pip call."""
+    if conda_deps:
+        if not env.backend.install(env.name, conda_deps, cwd=env.toxdir):
+            return False
+    if pip_deps:
+        if not safe_shell_out([env.pip, "install", "--quiet"] + pip_deps,
+                              cwd=env.toxdir):
+            return False
+
+    with open(env.envctoxfile, 'a') as f:
+        # Note: keep the order of env.deps, this is compared in prev_deps.
+        f.write(" " + " ".join(d for d in env.deps
+                               if d in conda_deps or d in pip_deps))
+    return True
+
+
+def split_deps(env, deps):
+    """Split deps into those which conda can install and those which are
+    left for pip, returns a tuple (conda_deps, pip_deps).
+
+    Deps we've seen before are looked up in the index in the cachedir,
+    the rest are checked with conda dry-runs. Returns None if conda fails for
+    some other reason than missing packages (e.g. conflicts).
+
+    """
+    from ctox.cache import index_path, read_json, write_json
+    path = index_path(env)
+    index = read_json(path, {})
+
+    unknown = candidates = [d for d in deps if d not in index]
+    while candidates:
+        missing = env.backend.not_found(env.name, candidates,
+                                        cwd=env.toxdir)
+        if missing is None:
+            return None
+        if not missing:
+            break
+        for d in missing:
+            index[d] = 'pip'
+        candidates = [d for d in candidates if d not in missing]
+
+    if unknown:
+        for d in candidates:
+            index[d] = 'conda'
+        # Merge with anything added by other processes since we read it.
+        from ctox.lock import file_lock
+        with file_lock(path):
+            write_json(path, dict(read_json(path, {}),
+                                  **dict((d, index[d]) for d in unknown)))
+
+    return ([d for d in deps if index[d] == 'conda'],
+            [d for d in deps if index[d] == 'pip'])
+
+
+def forget_deps(env, deps):
+    """Drop deps from the index (e.g. after installing them as it said
+    failed), so they're checked with conda dry-runs again next time."""
+    from ctox.cache import index_path, read_json, write_json
+    from ctox.lock import file_lock
+    path = index_path(env)
+    with file_lock(path):
+        index = read_json(path, {})
+        write_json(path, dict((d, how) for d, how in index.items()
+                              if d not in deps))
 
 
 def uninstall_deps(env, deps):
-    # TODO actually use this.
-    if deps:
-        print("removing previous deps...")
-        success = all(uninstall(env=env, lib=d) for d in deps[1:])
-        if (not success) or deps[0] != "pip":
-            cprint("    Environment dependancies mismatch, rebuilding.", 'err')
-            create_env(env, force_remove=True)
+    """Remove deps from env, those which we know conda installed are removed
+    in one conda transaction and those pip installed in one pip call.
+
+    Returns False if this would also remove, or break, packages which depend
+    on deps (which may be deps we keep), in which case the env should be
+    recreated.
+
+    """
+    if not deps:
+        return True
+    print("removing previous deps...")
+    from ctox.cache import index_path, read_json
+    index = read_json(index_path(env), {})
+    conda_deps = [d for d in deps if index.get(d) == 'conda']
+    pip_deps = [d for d in deps if index.get(d) == 'pip']
+    unknown = [d for d in deps if d not in conda_deps + pip_deps]
+
+    if conda_deps:
+        if not removes_only(env, conda_deps, strict=True):
+            return False
+        if not env.backend.remove(env.name, conda_deps, cwd=env.toxdir):
+            return False
+    if pip_deps:
+        if not safe_shell_out([env.pip, "uninstall", "--yes", "--quiet"] +
+                              pip_deps, cwd=env.toxdir):
+            return False
+    for d in unknown:
+        if not (removes_only(env, [d]) and uninstall(env=env, lib=d)):
+            return False
+    # conda doesn't know about what pip installed (and pip doesn't check
+    # when uninstalling), so check nothing left is missing a requirement.
+    return not (pip_deps or unknown) or safe_shell_out([env.pip, "check"],
+                                                       cwd=env.toxdir)
+
+
+def removes_only(env, deps, strict=False):
+    """Whether conda would remove just deps (and not what depends on them).
+
+    If conda can't tell (e.g. deps weren't installed by conda) returns not
+    strict.
+
+    """
+    from ctox.cache import dep_name
+    removes = env.backend.would_remove(env.name, deps, cwd=env.toxdir)
+    if removes is None:
+        return not strict
+    return set(removes) <= set(dep_name(d) for d in deps)
+
+
+def update_deps(env):
+    """Update an existing env from prev_deps to env.deps by installing the
+    added and removing the dropped deps.
+
+    Returns False if this isn't possible (e.g. a conda conflict or the python
+    version changes), in which case the env should be recreated.
+
+    """
+    from ctox.cache import dep_name
+    prev = prev_deps(env)
+    if not prev or prev[0] != "pip":
+        return False
+
+    added = [d for d in env.deps if d not in prev]
+    # Note: if the dep is still there (e.g. a changed pin) installing it
+    # will up/downgrade it, there's no need to remove it first.
+    added_names = set(dep_name(d) for d in added)
+    removed = [d for d in prev
+               if d not in env.deps and dep_name(d) not in added_names]
+    if 'python' in added_names:
+        return False
+
+    cprint("%s updatedeps: %s" % (env.name, ', '.join(
+        ['+' + d for d in added] + ['-' + d for d in removed])))
+    split = None
+    try:
+        split = split_deps(env, added)
+        success = (split is not None and
+                   uninstall_deps(env, removed) and
+                   install_batch(env, *split))
+    except (OSError, CalledProcessError):
+        success = False
+    if not success and split is not None:
+        forget_deps(env, added)
+
+    if success:
+        write_deps(env)
+        lock_env(env)
+    else:
+        cprint("    Environment dependancies mismatch, rebuilding.", 'err')
+    return success
+
 
+def write_deps(env):
     with open(env.envctoxfile, 'w') as f:
-        f.write("")
+        f.write(" " + " ".join(env.deps))
+
+
+def lock_env(env):
+    """Snapshot the exact conda packages and pip frozen versions installed in
+    env into its lockfile (and the lockfile in the cache).
+
+    Returns the lock, or None if conda or pip couldn't list the packages.
+
+    """
+    from ctox.cache import dep_name, lock_path, write_json
+    try:
+        explicit = env.backend.list_explicit(env.name, cwd=env.toxdir)
+        frozen = shell_out([env.pip, "freeze"], cwd=env.toxdir)
+    except (OSError, CalledProcessError):
+        # Don't leave a stale lockfile around (prev_deps reads from it).
+        if os.path.isfile(env.envlockfile):
+            os.remove(env.envlockfile)
+        return None
+    project = dep_name(env.package.rsplit('-', 1)[0])
+
+    lock = {'python': env.py_version,
+            'deps': env.deps,
+            'conda': [line for line in explicit.splitlines()
+                      if line and not line.startswith('#')],
+            # Note: skip the project itself.
+            'pip': [line for line in pip_requirements(frozen)
+                    if dep_name(line) != project]}
+    write_json(env.envlockfile, lock)
+    write_json(lock_path(env), lock)
+    return lock
+
+
+def pip_requirements(frozen):
+    """The lines of pip freeze output which can be reinstalled from pypi
+    (i.e. not editable installs or urls)."""
+    return [line for line in frozen.splitlines()
+            if line and not line.startswith('-e') and ' @ ' not in line]
+
+
+def cached_lock(env):
+    """Returns the lock (from the cache) for env's python version and deps, or
+    None if there isn't one."""
+    from ctox.cache import lock_path, read_json
+    lock = read_json(lock_path(env))
+    if lock and lock.get('deps') == env.deps and lock.get('conda'):
+        return lock
+
+
+def create_env_from_lock(env, lock):
+    """Create env from exactly the conda packages and pip versions in lock.
+
+    This doesn't need to solve, so is much faster than create_env followed by
+    install_deps. Returns False if this fails.
+
+    """
+    from ctox.cache import write_json
+    explicit = os.path.join(env.toxdir, "%s-explicit.txt" % env.name)
+    frozen = os.path.join(env.toxdir, "%s-frozen.txt" % env.name)
+    with open(explicit, 'w') as f:
+        f.write("\n".join(lock['conda']) + "\n")
+    with open(frozen, 'w') as f:
+        f.write("\n".join(lock['pip']) + "\n")
+    try:
+        env.backend.remove_env(env.name, cwd=env.toxdir)
+        success = (env.backend.create_explicit(env.name, explicit,
+                                               cwd=env.toxdir) and
+                   (not lock['pip'] or
+                    safe_shell_out([env.pip, 'install', '--no-deps',
+                                    '--quiet', '-r', frozen],
+                                   cwd=env.toxdir)))
+    except (OSError, CalledProcessError):
+        success = False
+    finally:
+        os.remove(explicit)
+        os.remove(frozen)
+
+    if success:
+        write_deps(env)
+        write_json(env.envlockfile, lock)
+    return success
 
 
 def prev_deps(env):
-    """Naively gets the dependancies from the last time ctox was run."""
-    # TODO something more clever.
+    """Gets the dependancies from the last time ctox was run.
+
+    These are read from the env's lockfile if it exists.
+
+    """
+    from ctox.cache import read_json
+    lock = read_json(env.envlockfile)
+    if lock and lock.get('python') == env.py_version:
+        return lock['deps']
+
     if not os.path.isfile(env.envctoxfile):
         return []
 
@@ -97,17 +609,80 @@ def make_dist(toxinidir, toxdir, package):
         return os.path.join(dist, package + ".zip")
 
 
+def dist_state_path(toxdir):
+    return os.path.join(toxdir, "dist", "ctox-sdist.json")
+
+
+def cached_dist(toxinidir, toxdir):
+    """Check whether the project is unchanged since the last sdist.
+
+    Returns a tuple (package, state), package is None if the sdist needs to
+    be rebuilt. Once it has been save_dist_state gives the new state.
+
+    """
+    from ctox.cache import read_json, tree_fingerprint, write_json
+    prev = read_json(dist_state_path(toxdir), {})
+    package = prev.get('package')
+    if not (package and 'sources' in prev and
+            os.path.isfile(os.path.join(toxdir, "dist", package + ".zip"))):
+        return None, prev
+    fingerprint, files = tree_fingerprint(toxinidir, prev['sources'],
+                                          prev.get('files'))
+    state = dict(prev, fingerprint=fingerprint, files=files)
+
+    if fingerprint == prev.get('fingerprint'):
+        if files != prev.get('files'):
+            # Only the stats changed (e.g. the files were touched).
+            write_json(dist_state_path(toxdir), state)
+        return package, state
+    return None, state
+
+
+def save_dist_state(toxinidir, toxdir, state, package):
+    """Fingerprint the files in the (just built) sdist of package, and save
+    that as the state checked by cached_dist. Returns the state."""
+    from ctox.cache import sdist_sources, tree_fingerprint, write_json
+    sources = sdist_sources(os.path.join(toxdir, "dist", package + ".zip"))
+    fingerprint, files = tree_fingerprint(toxinidir, sources,
+                                          state.get('files'))
+    state = {'package': package, 'sources': sources,
+             'fingerprint': fingerprint, 'files': files}
+    write_json(dist_state_path(toxdir), state)
+    return state
+
+
+def dist_installed(env):
+    """Whether the dist installed in env is the current package_zipped."""
+    if not os.path.isfile(env.envdistfile):
+        return False
+    from ctox.cache import file_hash
+    with open(env.envdistfile) as f:
+        return f.read().strip() == file_hash(env.package_zipped)
+
+
 def install_dist(env):
-    # TODO don't rebuild if not changed?
     # At the moment entire dir is wiped, really we want to update, which would
     # allow us to reuse  previously built files (e.g. pyc) if unchanged...
     # This is usually done in the setup.py into a directory...
+    from ctox.cache import file_hash
+    dist_hash = file_hash(env.package_zipped)
     print("installing...")
-    return safe_shell_out([env.pip, "install", env.package_zipped,
-                           "--no-deps", "--upgrade",
-                           # "-t", env.envdistdir,
-                           ],
-                          cwd=env.toxdir)
+    # Install from the wheel (shared by all envs with this python version),
+    # if it can't be built (or --force-reinstall) install from the zip.
+    dist = ((not env.force_reinstall and build_wheel(env, dist_hash)) or
+            env.package_zipped)
+    # Note: pip skips a wheel whose version is already installed (even if
+    # the code has changed), so force it.
+    success = safe_shell_out([env.pip, "install", dist,
+                              "--no-deps", "--force-reinstall",
+                              # "-t", env.envdistdir,
+                              ],
+                             cwd=env.toxdir)
+    if success:
+        # Record the hash of the zip so we can skip reinstalling next time.
+        with open(env.envdistfile, 'w') as f:
+            f.write(dist_hash)
+    return success
 
     # from zipfile import ZipFile
     # with ZipFile(env.package_zipped, "r") as z:
@@ -116,6 +691,62 @@ def install_dist(env):
     #                       cwd=env.envpackagedir)
 
 
+def wheel_dir(env, dist_hash):
+    return os.path.join(env.distdir, "wheels",
+                        "py%s-%s" % (env.py_version, dist_hash[:12]))
+
+
+def build_wheel(env, dist_hash):
+    """Build a wheel of package_zipped with env's python, returns its path.
+
+    The wheel is cached in the distdir so is only built once for each python
+    version. Returns None if the wheel couldn't be built.
+
+    """
+    from glob import glob
+    from ctox.lock import file_lock
+    wheeldir = wheel_dir(env, dist_hash)
+    wheels = glob(os.path.join(wheeldir, "*.whl"))
+    if wheels:
+        return wheels[0]
+
+    # Note: this also stops another env removing the wheel as it's built.
+    prefix = os.path.join(env.distdir, "wheels", "py%s" % env.py_version)
+    with file_lock(prefix):
+        # Check it wasn't built by another process whilst we waited.
+        wheels = glob(os.path.join(wheeldir, "*.whl"))
+        if wheels:
+            return wheels[0]
+        return _build_wheel(env, wheeldir)
+
+
+def _build_wheel(env, wheeldir):
+    """Build the wheel into wheeldir (with the lock held, see build_wheel)."""
+    from glob import glob
+    from shutil import rmtree
+    # Build into a temporary dir so a half-built wheel is never used.
+    tmp = "%s.%s.tmp" % (wheeldir, os.getpid())
+    success = safe_shell_out([env.pip, "wheel", env.package_zipped,
+                              "--no-deps", "--quiet", "--wheel-dir", tmp],
+                             cwd=env.toxdir)
+    wheels = glob(os.path.join(tmp, "*.whl"))
+    if not (success and wheels):
+        rmtree(tmp, ignore_errors=True)
+        return None
+
+    # Remove wheels of previous dists for this python version.
+    prefix = os.path.join(env.distdir, "wheels", "py%s-" % env.py_version)
+    for old in glob(prefix + "*"):
+        if not old.endswith(".tmp"):
+            rmtree(old, ignore_errors=True)
+    try:
+        os.rename(tmp, wheeldir)
+    except OSError:  # pragma: no cover
+        # Built concurrently by another env with this python version.
+        rmtree(tmp, ignore_errors=True)
+    return glob(os.path.join(wheeldir, "*.whl"))[0]
+
+
 def package_name(toxinidir):
     return '-'.join(shell_out(["python", "setup.py", "--name", "--version"],
                               cwd=toxinidir).split())
@@ -123,11 +754,21 @@ def package_name(toxinidir):
 
 def run_commands(env):
     # Note: it's important all these tests are run, no short-circuiting.
-    failing = any([run_one_command(env, c[:]) for c in env.commands])
+    results = []
+    failing = any([run_one_command(env, c[:], results=results)
+                   for c in env.commands])
+    from ctox.cache import write_json
+    write_json(env.envresultsfile, {'commands': results})
     return failing
 
 
-def run_one_command(env, command):
+def run_one_command(env, command, results=None):
+    """Run command in env, returns its exit code.
+
+    If results is a list the command, its exit code, wall time and resource
+    usage (see wait_rusage) are appended to it.
+
+    """
     # TODO move large part of this function to subst.parse_command.
     abbr_cmd, cmd, command = print_pretty_command(env, command)
 
@@ -143,8 +784,23 @@ def run_one_command(env, command):
 
     # Run the command!
     try:
-        p = Popen(command, cwd=env.changedir, stderr=STDOUT)
-        p.communicate()
+        with span(' '.join([abbr_cmd] + command[1:]), cat='command',
+                  cmd=' '.join(command)) as s:
+            # Note: the output is only logged when it's buffered.
+            log = log_command(command)
+            if env.buffered:
+                p = Popen(command, cwd=env.changedir, stdout=PIPE,
+                          stderr=STDOUT)
+                stream_lines(p, log=log, echo=sys.stdout.write)
+            else:
+                p = Popen(command, cwd=env.changedir, stderr=STDOUT)
+            rusage = wait_rusage(p)
+            s['args']['rusage'] = rusage
+        if rusage:
+            print_rusage(rusage)
+        if results is not None:
+            results.append({'command': command, 'returncode': p.returncode,
+                            'wall': s['dur'] / 1e6, 'rusage': rusage})
         return p.returncode
     except OSError as e:
         # Command not found locally (or not in whitelist).
@@ -152,9 +808,43 @@ def run_one_command(env, command):
         cprint("    Is %s in dependancies or whitelist_externals?\n"
                % abbr_cmd,
                'warn')
+        if results is not None:
+            results.append({'command': command, 'returncode': None,
+                            'wall': None, 'rusage': None})
         return 1
 
 
+def wait_rusage(p):
+    """Wait for the Popen p to exit, and set its returncode.
+
+    Returns a dict of the resource usage of the process (and its children):
+    user and sys cpu seconds, maxrss (peak resident memory in bytes) and
+    inblock and oublock (block input and output operations). Returns None
+    where this isn't available (e.g. on Windows).
+
+    """
+    try:
+        _, status, ru = os.wait4(p.pid, 0)
+    except AttributeError:  # no wait4 e.g. Windows, pragma: no cover
+        p.wait()
+        return None
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    # Note: maxrss is in bytes on OS X, and kilobytes elsewhere.
+    maxrss = ru.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return {'user': ru.ru_utime, 'sys': ru.ru_stime, 'maxrss': maxrss,
+            'inblock': ru.ru_inblock, 'oublock': ru.ru_oublock}
+
+
+def print_rusage(rusage):
+    print("    cpu %.2fs user %.2fs sys, max rss %.1fMB, "
+          "io %d in %d out blocks"
+          % (rusage['user'], rusage['sys'], rusage['maxrss'] / 1e6,
+             rusage['inblock'], rusage['oublock']))
+
+
 def print_pretty_command(env, command):
     """This is a hack for prettier printing.
 
@@ -1,10 +1,15 @@
 """This module contains light-weight wrappers to subprocess's check_output
 and colored printing."""
 
+from collections import deque
 from colorama import Fore, Style, init
 from contextlib import contextmanager
+from ctox.trace import span, command_name
+from subprocess import Popen, PIPE
+import io
 import os
 import sys
+import threading
 
 try:
     from StringIO import StringIO
@@ -66,29 +71,162 @@ def captured_output():
         sys.stdout, sys.stderr = old_out, old_err
 
 
+# The number of lines of output kept (in memory) from each command, see
+# stream_lines.
+TAIL_LINES = 40
+
+# The log file (if any) and the tail of the last failed command, see log_to.
+_local = threading.local()
+
+
+class PrefixedOutput(object):
+
+    """A file-like object which writes each line to the file descriptor fd,
+    prefixed with prefix.
+
+    Each line is written with a single os.write, so the lines of several
+    processes writing to the same terminal don't get mixed up.
+
+    """
+
+    def __init__(self, prefix, fd=1):
+        self.prefix = prefix
+        self.fd = fd
+        self.partial = ''
+
+    def write(self, s):
+        if isinstance(s, bytes) and not isinstance(s, str):
+            s = s.decode('utf-8', 'replace')
+        lines = (self.partial + s).split('\n')
+        self.partial = lines.pop()
+        if lines:
+            out = ''.join(self.prefix + line + '\n' for line in lines)
+            if not isinstance(out, bytes):
+                out = out.encode('utf-8')
+            os.write(self.fd, out)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Write the last line, even if it doesn't end in a newline."""
+        if self.partial:
+            self.write('\n')
+
+
+@contextmanager
+def prefixed_output(prefix):
+    """Write everything printed in this block to the terminal (immediately),
+    with each line prefixed with prefix."""
+    old_out, old_err = sys.stdout, sys.stderr
+    sys.stdout.flush()
+    new_out = PrefixedOutput(prefix)
+    try:
+        sys.stdout = sys.stderr = new_out
+        yield new_out
+    finally:
+        new_out.close()
+        sys.stdout, sys.stderr = old_out, old_err
+
+
+@contextmanager
+def log_to(path, mode='w'):
+    """Write the output of commands run by safe_shell_out in this block (and
+    this thread) to the file path."""
+    d = os.path.dirname(path)
+    if d and not os.path.isdir(d):
+        os.makedirs(d)
+    prev = getattr(_local, 'log', None)
+    with io.open(path, mode, encoding='utf-8') as f:
+        _local.log, _local.failure = f, None
+        try:
+            yield f
+        finally:
+            _local.log = prev
+
+
+def current_log():
+    """The file object output is being logged to (see log_to), or None."""
+    return getattr(_local, 'log', None)
+
+
+def stream_lines(p, log=None, echo=None, tail=TAIL_LINES):
+    """Read the output of the Popen p (which must have stdout=PIPE) line by
+    line until it's closed, rather than holding all of it in memory.
+
+    Each line is written to the file log and passed to echo (if given).
+    Returns a deque of the last tail lines.
+
+    """
+    lines = deque(maxlen=tail)
+    for line in iter(p.stdout.readline, b''):
+        line = line.decode('utf-8', 'replace')
+        lines.append(line)
+        if log is not None:
+            log.write(line)
+        if echo is not None:
+            echo(line)
+    p.stdout.close()
+    if log is not None:
+        log.flush()
+    return lines
+
+
+def log_command(cmd):
+    """Write a header line for cmd to the current log (if any)."""
+    log = current_log()
+    if log is not None:
+        log.write(u"$ %s\n" % ' '.join(cmd))
+    return log
+
+
+def last_failure():
+    """A tuple of the last command which failed in safe_shell_out (in this
+    thread) and the tail of its output, or None."""
+    return getattr(_local, 'failure', None)
+
+
 def safe_shell_out(cmd, verbose=False, **kwargs):
     """run cmd and return True if it went ok, False if something went wrong.
 
-    Suppress all output.
+    Suppress all output, other than logging it (see log_to).
 
     """
     # TODO rename this suppressed_shell_out ?
     # TODO this should probably return 1 if there's an error (i.e. vice-versa).
-    # print("cmd %s" % cmd)
+    log = log_command(cmd)
     try:
-        with open(os.devnull, "w") as fnull:
-            with captured_output():
-                check_output(cmd, stderr=fnull, **kwargs)
-        return True
-    except (CalledProcessError, OSError) as e:
-        if verbose:
-            cprint("    Error running command %s" % ' '.join(cmd), 'err')
-            print(e.output)
-        return False
+        with span(command_name(cmd), cmd=' '.join(cmd)):
+            p = Popen(cmd, stdout=PIPE, stderr=STDOUT, **kwargs)
+            tail = stream_lines(p, log=log)
+            returncode = p.wait()
     except Exception as e:
-        # TODO no idea
-        # Can this be if you try and unistall pip? (don't do that)
-        return False
+        # e.g. OSError if cmd isn't found.
+        returncode, tail = None, [str(e)]
+    if returncode == 0:
+        return True
+
+    _local.failure = (cmd, tail)
+    if verbose:
+        cprint("    Error running command %s" % ' '.join(cmd), 'err')
+        print(''.join(tail))
+    return False
+
+
+def print_failure():
+    """Print the tail of the output of the last command which failed in
+    safe_shell_out, and where it was logged."""
+    failure = last_failure()
+    if failure is None:
+        return
+    cmd, tail = failure
+    cprint("    %s failed, last %d lines of output:"
+           % (' '.join(cmd), len(tail)), 'err')
+    for line in tail:
+        print("    " + line.rstrip())
+    log = current_log()
+    if log is not None:
+        cprint("    full output in %s" % log.name, 'warn')
 
 
 def shell_out(cmd, stderr=STDOUT, cwd=None):
@@ -96,7 +234,9 @@ def shell_out(cmd, stderr=STDOUT, cwd=None):
     if cwd is None:
         from os import getcwd
         cwd = getcwd()  # TODO do I need to normalize this on Windows
-    out = check_output(cmd, cwd=cwd, stderr=stderr, universal_newlines=True)
+    with span(command_name(cmd), cmd=' '.join(cmd)):
+        out = check_output(cmd, cwd=cwd, stderr=stderr,
+                           universal_newlines=True)
     return _clean_output(out)
 
 
@@ -7,8 +7,20 @@ The most useful are bash_expand and replace_braces.
 import os
 import re
 
+from weakref import WeakKeyDictionary
 
-DEPTH = 5
+
+# Compiled templates, see compile_template.
+_TEMPLATES = {}
+
+# Compiled factor conditions, see factor_index.
+_FACTOR_INDEXES = {}
+_FACTOR_LABELS = {}
+_ENV_FACTORS = {}
+
+# Env independent substitutions (e.g. {env:KEY} and the raw {[section]option}
+# values) for each config, these are shared between envs.
+_CONFIG_CACHES = WeakKeyDictionary()
 
 
 def parse_commands(env):
@@ -27,7 +39,17 @@ def parse_envlist(s):
 
     """
     # TODO some other substitutions?
-    return bash_expand(s)
+    return list(iter_envlist(s))
+
+
+def iter_envlist(s):
+    """Generator of the envs in the tox.ini's envlist (see parse_envlist)."""
+    for e in ibash_expand(s):
+        yield e
+
+
+def _curly_options(curly):
+    return re.split(r"\s*,\s*", curly[1:-1])
 
 
 def expand_curlys(s):
@@ -39,16 +61,22 @@ def expand_curlys(s):
     ["py26", "py27"]
 
     """
-    from functools import reduce
-    curleys = list(re.finditer(r"{[^{}]*}", s))
-    return reduce(_replace_curly, reversed(curleys), [s])
+    return list(iexpand_curlys(s))
 
 
-def _replace_curly(envlist, match):
-    assert isinstance(envlist, list)
-    return [e[:match.start()] + m + e[match.end():]
-            for m in re.split(r"\s*,\s*", match.group()[1:-1])
-            for e in envlist]
+def iexpand_curlys(s):
+    """Generator version of expand_curlys.
+
+    Note: the first curly varies slowest (as in bash).
+
+    """
+    from itertools import product
+    parts = re.split(r"({[^{}]*})", s)
+    literals = parts[::2]
+    options = [_curly_options(c) for c in parts[1::2]]
+    for choice in product(*options):
+        yield ''.join(lit + m for lit, m in zip(literals, choice)) + \
+            literals[-1]
 
 
 def bash_expand(s):
@@ -63,7 +91,14 @@ def bash_expand(s):
     "py32"]
 
     """
-    return sum([expand_curlys(t) for t in _split_out_of_braces(s)], [])
+    return list(ibash_expand(s))
+
+
+def ibash_expand(s):
+    """Generator version of bash_expand."""
+    for t in _split_out_of_braces(s):
+        for e in iexpand_curlys(t):
+            yield e
 
 
 def _split_out_of_braces(s):
@@ -97,23 +132,80 @@ def expand_factor_conditions(s, env):
     >>> expand_factor_conditions(s, Env(name="py26", ...))
     ""
 
+    """
+    return expand_factor_lines(s, env)[0]
+
+
+def expand_factor_lines(s, env):
+    """Expand the factor conditions of each line of s (see
+    expand_factor_conditions), returns a list of lines.
+
+    Note: s is compiled once into a factor index, so this is just a set lookup
+    of env's factors.
+
+    """
+    values, unconditional, by_factor = factor_index(s)
+    matched = set(unconditional)
+    if by_factor:
+        for factor in _env_factors(env.name):
+            matched.update(by_factor.get(factor, ()))
+    return [v if i in matched else '' for i, v in enumerate(values)]
+
+
+def factor_index(s):
+    """Compile the lines of s, returns a tuple (values, unconditional,
+    by_factor).
+
+    values is the value of each line (with any factor condition removed),
+    unconditional the indices of lines without a factor condition and
+    by_factor a dict of factor to indices of the lines it matches.
+
+    Example
+    -------
+    >>> factor_index("nose\npy{33,34}: docformatter")
+    (['nose', 'docformatter'], [0], {'py33': [1], 'py34': [1]})
+
     """
     try:
-        factor, value = re.split(r'\s*\:\s*', s)
-    except ValueError:
-        return s
+        return _FACTOR_INDEXES[s]
+    except KeyError:
+        pass
 
-    if matches_factor_conditions(factor, env):
-        return value
-    else:
-        return ''
+    values, unconditional, by_factor = [], [], {}
+    for i, line in enumerate(s.split("\n")):
+        try:
+            factor, value = re.split(r'\s*\:\s*', line)
+        except ValueError:
+            values.append(line)
+            unconditional.append(i)
+            continue
+        values.append(value)
+        for label in _factor_labels(factor):
+            by_factor.setdefault(label, []).append(i)
+
+    index = _FACTOR_INDEXES[s] = values, unconditional, by_factor
+    return index
 
 
 def matches_factor_conditions(s, env):
     """"Returns True if py{33, 34} expanded is contained in env.name."""
-    env_labels = set(env.name.split('-'))
-    labels = set(bash_expand(s))
-    return bool(labels & env_labels)
+    return not _factor_labels(s).isdisjoint(_env_factors(env.name))
+
+
+def _factor_labels(s):
+    try:
+        return _FACTOR_LABELS[s]
+    except KeyError:
+        labels = _FACTOR_LABELS[s] = frozenset(ibash_expand(s))
+        return labels
+
+
+def _env_factors(name):
+    try:
+        return _ENV_FACTORS[name]
+    except KeyError:
+        factors = _ENV_FACTORS[name] = frozenset(name.split('-'))
+        return factors
 
 
 def split_on(s, sep=" "):
@@ -143,18 +235,85 @@ def replace_braces(s, env):
     passed).
 
     """
-    def replace(m):
-        return _replace_match(m, env)
-    for _ in range(DEPTH):
-        s = re.sub(r"{[^{}]*}", replace, s)
-    return s
+    return _render(compile_template(s), env)
+
+
+def compile_template(s):
+    """Parse s into a template, a list of strings and (nested) tuples which
+    are the contents of a pair of curly braces.
+
+    Example
+    -------
+    >>> compile_template("echo {posargs:{env:USER:} passed}")
+    ['echo ', ('posargs:', ('env:USER:',), ' passed')]
+
+    Note: unmatched braces are left as they are. Templates are memoized.
+
+    """
+    try:
+        return _TEMPLATES[s]
+    except KeyError:
+        pass
+
+    stack = [[]]
+    text = []
+    for c in s:
+        if c == '{':
+            stack[-1].append(''.join(text))
+            stack.append([])
+            text = []
+        elif c == '}' and len(stack) > 1:
+            stack[-1].append(''.join(text))
+            sub = tuple(p for p in stack.pop() if p != '')
+            stack[-1].append(sub)
+            text = []
+        else:
+            text.append(c)
+    stack[-1].append(''.join(text))
+
+    # Any braces still open were never closed, so are just text.
+    while len(stack) > 1:
+        unclosed = stack.pop()
+        stack[-1].append('{')
+        stack[-1].extend(unclosed)
+
+    template = _join_text(stack[0])
+    _TEMPLATES[s] = template
+    return template
+
+
+def _join_text(parts):
+    template = []
+    for p in parts:
+        if isinstance(p, tuple) or not template or \
+                isinstance(template[-1], tuple):
+            template.append(p)
+        else:
+            template[-1] += p
+    return [p for p in template if p != '']
+
+
+def _render(template, env):
+    return ''.join(p if not isinstance(p, tuple)
+                   else _replace_match(_render(p, env), env)
+                   for p in template)
+
+
+def _config_cache(env):
+    config = getattr(env, 'config', None)
+    if config is None:
+        return {}
+    try:
+        return _CONFIG_CACHES.setdefault(config, {})
+    except TypeError:  # pragma: no cover
+        # config can't be weak referenced.
+        return {}
 
 
-def _replace_match(m, env):
-    """Given a match object, having matched something inside curly braces,
-    replace the contents if matches one of the supported tox-substitutions."""
-    # ditch the curly braces
-    s = m.group()[1:-1].strip()
+def _replace_match(s, env):
+    """Given the contents of a pair of curly braces, replace them if they
+    match one of the supported tox-substitutions."""
+    s = s.strip()
 
     try:
         # get the env attributes e.g. envpython or toxinidir.
@@ -173,26 +332,39 @@ def _replace_match(m, env):
     raise NotImplementedError("{%s} not understood in tox.ini file." % s)
 
 
-def _replace_envvar(s, _):
+def _replace_envvar(s, env):
     """env:KEY or env:KEY:DEFAULT"""
+    cache = _config_cache(env)
+    if s in cache:
+        return cache[s]
+
     e = s.split(":")
     if len(e) > 3 or len(e) == 1 or e[0] != "env":
         raise ValueError()
     elif len(e) == 2:
         # Note: this can/should raise a KeyError (according to spec).
-        return os.environ[e[1]]
+        value = os.environ[e[1]]
     else:  # len(e) == 3
-        return os.environ.get(e[1], e[2])
+        value = os.environ.get(e[1], e[2])
+    cache[s] = value
+    return value
 
 
 def _replace_config(s, env):
-    """[sectionname]optionname"""
+    """[sectionname]optionname
+
+    Note: the value is itself substituted (after expanding factors).
+
+    """
     m = re.match(r"\[(.*?)\](.*)", s)
     if m:
-        section, option = m.groups()
-        expanded = env.config.get(section, option)
-        return '\n'.join([expand_factor_conditions(e, env)
-                          for e in expanded.split("\n")])
+        cache = _config_cache(env)
+        if s not in cache:
+            section, option = m.groups()
+            cache[s] = env.config.get(section, option)
+        expanded = cache[s]
+        return replace_braces('\n'.join(expand_factor_lines(expanded, env)),
+                              env)
     else:
         raise ValueError()
 
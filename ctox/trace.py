@@ -0,0 +1,101 @@
+"""This module contains timing spans, which are recorded around each phase of
+an env and each subprocess ctox runs.
+
+These can be printed as a table (--timings) or written as a chrome trace
+(--trace), which can be opened in chrome://tracing or ui.perfetto.dev.
+
+"""
+
+from contextlib import contextmanager
+from timeit import default_timer as timer
+import os
+import time
+
+# The spans recorded in this process, each is a dict of name, cat(egory), env,
+# ts (start in microseconds since the epoch), dur(ation) in microseconds, pid
+# and depth.
+_SPANS = []
+
+# The spans which have been entered but not exited.
+_STACK = []
+
+
+@contextmanager
+def span(name, cat='cmd', env=None, **args):
+    """Record the time spent in the block as a span.
+
+    env defaults to the env of the enclosing span. Yields the span dict, its
+    dur is available once the block has exited.
+
+    """
+    if env is None:
+        env = _STACK[-1]['env'] if _STACK else 'GLOB'
+    s = {'name': name, 'cat': cat, 'env': env, 'args': args,
+         'ts': time.time() * 1e6, 'pid': os.getpid(), 'depth': len(_STACK)}
+    _STACK.append(s)
+    start = timer()
+    try:
+        yield s
+    finally:
+        s['dur'] = (timer() - start) * 1e6
+        _STACK.pop()
+        _SPANS.append(s)
+
+
+def command_name(cmd):
+    """A short name for the command cmd (a list), e.g. "conda install"."""
+    name = [os.path.basename(cmd[0])]
+    if len(cmd) > 1 and not cmd[1].startswith('-'):
+        name.append(cmd[1])
+    return ' '.join(name)
+
+
+def spans():
+    return list(_SPANS)
+
+
+def add_spans(spans):
+    """Add spans recorded in another process."""
+    _SPANS.extend(spans)
+
+
+def reset():
+    del _SPANS[:]
+    del _STACK[:]
+
+
+def print_timings(envlist, spans):
+    """Print a table of the phases of each env (and the sdist etc. of GLOB),
+    with the subprocesses run in each."""
+    from ctox.shell import cprint
+    cprint('Timings')
+    print("-" * 23)
+    by_env = {}
+    for s in sorted(spans, key=lambda s: s['ts']):
+        by_env.setdefault(s['env'], []).append(s)
+    for env_name in ['GLOB'] + list(envlist):
+        env_spans = by_env.get(env_name, [])
+        # Only show the phases and what they run directly.
+        top = min([s['depth'] for s in env_spans] or [0])
+        for s in env_spans:
+            if s['depth'] > top + 1:
+                continue
+            name = "  " * (s['depth'] - top) + s['name']
+            if len(name) > 40:
+                name = name[:37] + '...'
+            print("%-12s %-40s %8.2fs" % (env_name, name, s['dur'] / 1e6))
+
+
+def write_trace(path, envlist, spans):
+    """Write spans as a chrome trace (each env is shown as a thread)."""
+    from ctox.cache import write_json
+    tids = dict((e, i) for i, e in enumerate(['GLOB'] + list(envlist)))
+    pid = os.getpid()
+    events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+               'args': {'name': e}} for e, tid in tids.items()]
+    for s in spans:
+        args = dict(s['args'], pid=s['pid'])
+        events.append({'name': s['name'], 'cat': s['cat'], 'ph': 'X',
+                       'ts': s['ts'], 'dur': s['dur'], 'pid': pid,
+                       'tid': tids.get(s['env'], len(tids)), 'args': args})
+    write_json(path, {'traceEvents': events, 'displayTimeUnit': 'ms'})
@@ -0,0 +1,112 @@
+from tests.util import *
+
+from ctox.cache import *
+
+
+class TestCache(TempDirTestCase):
+
+    def test_env_key_normalized(self):
+        env1 = DummyEnv(py_version="3.4", deps=["pip", "Django_Foo", "nose"])
+        env2 = DummyEnv(py_version="3.4", deps=["pip", "nose", "django-foo"])
+        self.assertEqual(env_key(env1), env_key(env2))
+
+    def test_env_key_python_version(self):
+        env1 = DummyEnv(py_version="3.4", deps=["pip", "nose"])
+        env2 = DummyEnv(py_version="3.5", deps=["pip", "nose"])
+        self.assertNotEqual(env_key(env1), env_key(env2))
+
+    def test_cached_env_path(self):
+        env = DummyEnv(py_version="3.4", deps=["pip"], cachedir="foo")
+        res = cached_env_path(env)
+        self.assertEqual(res, os.path.join("foo", "envs", env_key(env)))
+
+    def test_dep_name(self):
+        self.assertEqual(dep_name("Django_Foo>=1.8"), "django-foo")
+        self.assertEqual(dep_name("six[version='>=1.0']"), "six")
+
+    def test_write_read_json(self):
+        d = self.d
+        path = os.path.join(d, "sub", "foo.json")
+        write_json(path, {"a": 1})
+        self.assertEqual(read_json(path), {"a": 1})
+        self.assertEqual(read_json(path + "x", {}), {})
+
+    def test_tree_fingerprint(self):
+        d = self.d
+
+        def write(rel, contents="foo"):
+            path = os.path.join(d, *rel.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as f:
+                f.write(contents)
+
+        for rel in ("setup.py", "mypkg/__init__.py", "mypkg/build/x.py",
+                    ".tox/ignored"):
+            write(rel)
+        sources = ["setup.cfg", "setup.py", "mypkg/__init__.py",
+                   "mypkg/build/x.py"]
+        fp, index = tree_fingerprint(d, sources)
+        self.assertEqual(sorted(index), ["mypkg/__init__.py",
+                                         "mypkg/build/x.py", "setup.py"])
+
+        # Files which aren't in the sdist are ignored.
+        write("s1.json")
+        os.mkdir(os.path.join(d, "build"))
+        self.assertEqual(tree_fingerprint(d, sources)[0], fp)
+
+        os.utime(os.path.join(d, "setup.py"), (0, 0))
+        fp2, index2 = tree_fingerprint(d, sources, index)
+        self.assertEqual(fp, fp2)
+        self.assertNotEqual(index, index2)
+
+        write("mypkg/build/x.py", "baz")
+        fp3, index3 = tree_fingerprint(d, sources, index2)
+        self.assertNotEqual(fp, fp3)
+
+        # New files in the sdist's directories (or new packages) count.
+        write("mypkg/new.py")
+        fp4, _ = tree_fingerprint(d, sources, index3)
+        self.assertNotEqual(fp3, fp4)
+        write("newpkg/__init__.py")
+        self.assertNotEqual(tree_fingerprint(d, sources, index3)[0], fp4)
+
+    def test_sdist_sources(self):
+        from zipfile import ZipFile
+        zipped = os.path.join(self.d, "proj-0.1.zip")
+        z = ZipFile(zipped, "w")
+        for name in ("proj-0.1/", "proj-0.1/setup.py", "proj-0.1/PKG-INFO",
+                     "proj-0.1/proj/__init__.py",
+                     "proj-0.1/proj.egg-info/SOURCES.txt"):
+            z.writestr(name, "")
+        z.close()
+        self.assertEqual(sdist_sources(zipped),
+                         ["proj/__init__.py", "setup.py"])
+
+    def test_result_key(self):
+        d = self.d
+        env = DummyEnv(envlockfile=os.path.join(d, "ctox.lock"),
+                       envpassedfile=os.path.join(d, "ctox-passed"),
+                       commands=[["nosetests"]], changedir=d,
+                       options=[])
+        self.assertIsNone(result_key(env, "fp"))
+
+        write_json(env.envlockfile, {"deps": ["pip", "nose"]})
+        key = result_key(env, "fp")
+        self.assertIsNotNone(key)
+        self.assertNotEqual(key, result_key(env, "fp2"))
+        env.options = ["--", "--pdb"]
+        self.assertNotEqual(key, result_key(env, "fp"))
+        env.options = []
+
+        self.assertFalse(passed_before(env, key))
+        mark_passed(env, key)
+        self.assertTrue(passed_before(env, key))
+        env.commands = [["nosetests", "-x"]]
+        self.assertFalse(passed_before(env, result_key(env, "fp")))
+        mark_passed(env, None)
+        self.assertFalse(os.path.exists(env.envpassedfile))
+
+
+if __name__ == '__main__':
+    test_main()
@@ -3,7 +3,7 @@ from tests.util import *
 from ctox.config import *
 
 
-class TestConfig(TestCase):
+class TestConfig(TempDirTestCase):
 
     config = read_config(TOXINIFILE)
 
@@ -28,6 +28,40 @@ class TestConfig(TestCase):
         exp = ['pip', 'argparse', 'unittest2', 'nose', 'colorama', 'pyfaker']
         self.assertEqual(res, exp)
 
+    def test_load_plan(self):
+        d = self.d
+        toxinifile = os.path.join(d, "tox.ini")
+        with open(toxinifile, "w") as f:
+            f.write("[testenv]\ncommands = echo {env:CTOXTESTKEY:}\n")
+        plan = {'envlist': ['foo'], 'backend': 'conda',
+                'envs': {'foo': {'requirements': None}}}
+        inputs = plan_inputs(options=['a'])
+        save_plan(d, inputs, toxinifile, plan)
+        self.assertEqual(load_plan(d, inputs)['envlist'], ['foo'])
+        self.assertEqual(load_plan(d, plan_inputs(options=[])), None)
+
+        os.environ['CTOXTESTKEY'] = 'bar'
+        try:
+            self.assertEqual(load_plan(d, inputs), None)
+        finally:
+            del os.environ['CTOXTESTKEY']
+
+        with open(toxinifile, "a") as f:
+            f.write("deps = nose\n")
+        self.assertEqual(load_plan(d, inputs), None)
+
+    def test_load_plan_no_toxini(self):
+        d = self.d
+        toxinifile = os.path.join(d, "tox.ini")
+        plan = {'envlist': [], 'backend': 'conda', 'envs': {}}
+        inputs = plan_inputs(options=[])
+        save_plan(d, inputs, toxinifile, plan)
+        self.assertEqual(load_plan(d, inputs)['envlist'], [])
+
+        with open(toxinifile, "w") as f:
+            f.write("[tox]\nenvlist = py34\n")
+        self.assertEqual(load_plan(d, inputs), None)
+
     # TODO def test_get_commands (too unstable atm)
 
 
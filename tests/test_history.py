@@ -0,0 +1,62 @@
+from tests.util import *
+
+from ctox.history import *
+
+
+class TestHistory(TempDirTestCase):
+
+    def test_longest_first(self):
+        history = {"a": {"create": 1, "runtests": 1},
+                   "b": {"runtests": 5}}
+        res = longest_first(["a", "b", "c"], history)
+        self.assertEqual(res, ["b", "c", "a"])
+
+    def test_longest_first_no_history(self):
+        res = longest_first(["a", "b", "c"], {})
+        self.assertEqual(res, ["a", "b", "c"])
+
+    def test_record_history(self):
+        d = self.d
+        record_history(d, {"a": {"runtests": 1}, "b": {"runtests": 2}})
+        record_history(d, {"a": {"create": 3}})
+        res = read_history(d)
+        self.assertEqual(res, {"a": {"create": 3}, "b": {"runtests": 2}})
+
+    def test_format_duration(self):
+        self.assertEqual(format_duration(1.23), "1.2s")
+        self.assertEqual(format_duration(125), "2m05s")
+
+    def test_shard_round_robin(self):
+        envlist = ["a", "b", "c", "d", "e"]
+        self.assertEqual(shard(envlist, 1, 2, {}), ["a", "c", "e"])
+        self.assertEqual(shard(envlist, 2, 2, {}), ["b", "d"])
+
+    def test_shard_balanced(self):
+        envlist = ["a", "b", "c", "d", "e"]
+        history = {"a": {"runtests": 1}, "b": {"runtests": 8},
+                   "c": {"runtests": 4}, "d": {"runtests": 4}}
+        shards = [shard(envlist, i, 3, history) for i in (1, 2, 3)]
+        self.assertEqual(shards, [["b"], ["a", "e"], ["c", "d"]])
+
+    def test_merge_summaries(self):
+        d = self.d
+        s1, s2 = os.path.join(d, "s1.json"), os.path.join(d, "s2.json")
+        write_summary(s1, ["a"], {"a": 0}, {"a": {"runtests": 1}})
+        # c was lost so has no durations.
+        write_summary(s2, ["b", "c"], {"b": 1, "c": 2}, {"b": {}})
+        res = merge_summaries([s1, s2])
+        self.assertEqual(res, (["a", "b", "c"], {"a": 0, "b": 1, "c": 2},
+                               {"a": {"runtests": 1}, "b": {}, "c": {}}))
+
+    def test_record_outcomes(self):
+        d = self.d
+        record_outcomes(d, {"a": 1, "b": False, "c": 2})
+        record_outcomes(d, {"a": 0})
+        self.assertEqual(read_outcomes(d), {"a": 0, "b": 0, "c": 2})
+
+    def test_failed_first(self):
+        outcomes = {"a": 0, "b": 1, "c": 2, "d": 1}
+        envlist = ["a", "b", "c", "d", "e"]
+        self.assertEqual(failed_first(envlist, outcomes),
+                         ["b", "d", "a", "c", "e"])
+        self.assertEqual(only_failed(envlist, outcomes), ["b", "d"])
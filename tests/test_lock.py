@@ -0,0 +1,40 @@
+from tests.util import *
+
+from ctox.lock import *
+from ctox.lock import _try_lock, _unlock, fcntl, msvcrt
+
+
+class TestLock(TempDirTestCase):
+
+    def setUp(self):
+        if fcntl is None and msvcrt is None:
+            raise SkipTest("file locking is not available")
+        TempDirTestCase.setUp(self)
+
+    def test_file_lock(self):
+        path = os.path.join(self.d, "sub", "py34")
+        with file_lock(path):
+            self.assertTrue(os.path.isfile(path + ".lock"))
+            with open(path + ".lock", 'a+') as f:
+                self.assertFalse(_try_lock(f))
+        with open(path + ".lock", 'a+') as f:
+            self.assertTrue(_try_lock(f))
+            _unlock(f)
+
+    def test_file_lock_waits(self):
+        import threading
+        path = os.path.join(self.d, "py34")
+        waited, order = [], []
+
+        def other():
+            with file_lock(path, wait=lambda: waited.append(True)):
+                order.append("other")
+
+        with file_lock(path):
+            t = threading.Thread(target=other)
+            t.start()
+            t.join(0.2)
+            order.append("first")
+        t.join()
+        self.assertEqual(waited, [True])
+        self.assertEqual(order, ["first", "other"])
@@ -7,7 +7,7 @@ from ctox.main import *
 # For the moment we rely on integration testing.
 
 
-class TestMain(TestCase):
+class TestMain(TempDirTestCase):
 
     def test_positional_args(self):
         arguments = ['arg1', 'arg2', '--kwarg']
@@ -31,6 +31,125 @@ class TestMain(TestCase):
         exp = ['arg', '--kwarg']
         self.assertEqual(res, exp)
 
+    def test_parse_args_parallel(self):
+        args, res = parse_args(['-p', '4', 'arg'])
+        self.assertEqual(args.parallel, 4)
+        self.assertEqual(res, ['arg'])
+
+    def test_parse_args_shard(self):
+        from ctox.shell import captured_output
+        args, res = parse_args(['--shard', '2/3'])
+        self.assertEqual(args.shard, (2, 3))
+        with captured_output():
+            self.assertRaises(SystemExit, parse_args, ['--shard', '4/3'])
+            self.assertRaises(SystemExit, parse_args, ['--shard', '2'])
+
+    def test_prepare_force_reinstall(self):
+        from ctox.shell import captured_output
+        installs = []
+        env = DummyEnv(name="py34", envdir="py34", envdistdir="py34/dist",
+                       force_reinstall=False,
+                       env_exists=lambda: True, reusableable=lambda: False,
+                       dist_installed=lambda: True,
+                       install_dist=lambda: installs.append(1) or True)
+        with captured_output():
+            self.assertEqual(env.prepare(), 0)
+            self.assertEqual(installs, [])
+            env.force_reinstall = True
+            self.assertEqual(env.prepare(), 0)
+            self.assertEqual(installs, [1])
+
+    def test_replay_logs(self):
+        from ctox.shell import captured_output
+        import time
+        toxdir = self.d
+        for env_name, log in [("py27", "setup.log"),
+                              ("py34", "setup.log"),
+                              ("py34", "runtests.log"),
+                              ("py35", "runtests.log")]:
+            d = os.path.join(toxdir, "log", env_name)
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            with open(os.path.join(d, log), "w") as f:
+                f.write("%s %s\n" % (env_name, log))
+        failing = {"py27": 1, "py34": 1, "py35": 0}
+        with captured_output() as (out, _):
+            replay_logs(["py27", "py34", "py35"], failing, toxdir,
+                        since=time.time() - 60)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([line for line in lines if line.startswith("py")],
+                         ["py27 setup.log", "py34 runtests.log"])
+
+    def test_run_parallel_pipeline(self):
+        # Only envs which were setup ok run their commands.
+        failing, durations, _ = _run_parallel(["py27", "broken", "red"])
+        self.assertEqual(failing, {"py27": 0, "broken": 1, "red": 1})
+        self.assertEqual(durations, {"py27": {"setup": 1, "runtests": 2},
+                                     "broken": {"setup": 1},
+                                     "red": {"setup": 1, "runtests": 2}})
+
+    def test_run_parallel_order(self):
+        # Envs are setup in the order of envlist (e.g. longest first).
+        log = os.path.join(self.d, "log")
+        envlist = ["py35", "py27", "py34", "py26", "py33"]
+        _run_parallel(envlist, setup_processes=1, log=log)
+        with open(log) as f:
+            setups = [line.split()[1] for line in f.read().splitlines()
+                      if line.startswith("setup")]
+        self.assertEqual(setups, envlist)
+
+    def test_print_summary_lost_env(self):
+        from ctox.shell import captured_output
+        with captured_output() as (out, _):
+            print_summary(["py27", "dies"], {"py27": 0, "dies": 1},
+                          {"py27": {"setup": 1}})
+        self.assertTrue("dies commands failed" in out.getvalue())
+
+    def test_run_parallel_lost_env(self):
+        # An env whose worker dies, or whose result can't be pickled, fails
+        # rather than hanging ctox.
+        failing, durations, out = _run_parallel(["py27", "dies",
+                                                 "unpicklable"])
+        self.assertEqual(failing, {"py27": 0, "dies": 1, "unpicklable": 1})
+        self.assertEqual(durations, {"py27": {"setup": 1, "runtests": 2},
+                                     "dies": {}, "unpicklable": {}})
+        self.assertTrue("dies was lost" in out)
+        self.assertTrue("unpicklable was lost" in out)
+
+
+def _run_parallel(envlist, setup_processes=2, **kwargs):
+    """run_parallel with _fake_env as the worker, returns its result and
+    output."""
+    from ctox.shell import captured_output
+    import ctox.main
+    orig = ctox.main._ctox_env
+    ctox.main._ctox_env = _fake_env
+    try:
+        plan = dict((e, None) for e in envlist)
+        with captured_output() as (out, _):
+            failing, durations = run_parallel(envlist, 2, setup_processes,
+                                              plan, **kwargs)
+    finally:
+        ctox.main._ctox_env = orig
+    return failing, durations, out.getvalue()
+
+
+def _fake_env(stage, kwargs):
+    """A stand-in for _ctox_env, the env's name says what goes wrong."""
+    from ctox.main import _announce
+    name = kwargs['name']
+    _announce(name, stage)
+    if 'log' in kwargs:
+        with open(kwargs['log'], 'a') as f:
+            f.write("%s %s\n" % (stage, name))
+    if name == "dies":
+        os._exit(1)
+    if name == "unpicklable":
+        return stage, name, lambda: 0, {}, [], None
+    outcome = int((stage, name) in [("setup", "broken"), ("runtests", "red")])
+    took = {stage: 1 if stage == 'setup' else 2}
+    return stage, name, outcome, took, [], None
+
 
 if __name__ == '__main__':
     test_main()
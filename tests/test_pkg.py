@@ -7,7 +7,7 @@ from ctox.pkg import *
 # deps etc. is pretty slow. Perhap we could only run in in one env?
 
 
-class TestPkg(TestCase):
+class TestPkg(TempDirTestCase):
 
     def test_print_pretty_command(self):
         from ctox.shell import captured_output
@@ -18,6 +18,347 @@ class TestPkg(TestCase):
         exp = "(foo)$ bar\n"
         self.assertEqual(out.getvalue(), exp)
 
+    def test_split_deps_from_index(self):
+        from ctox.cache import write_json, index_path
+        d = self.d
+        env = DummyEnv(cachedir=d, name="foo", toxdir=d,
+                       py_version="3.4", backend=FakeBackend())
+        write_json(index_path(env), {"pip": "conda", "nose": "conda",
+                                     "pyfaker": "pip"})
+        res = split_deps(env, ["pip", "pyfaker", "nose"])
+        exp = (["pip", "nose"], ["pyfaker"])
+        self.assertEqual(res, exp)
+        self.assertEqual(env.backend.calls, [])
+
+        # the index isn't used for other python versions
+        env.py_version = "2.7"
+        res = split_deps(env, ["pip", "pyfaker", "nose"])
+        self.assertEqual(res, (["pip", "pyfaker", "nose"], []))
+        self.assertEqual(len(env.backend.calls), 1)
+
+    def test_prev_deps_from_lock(self):
+        from ctox.cache import write_json
+        d = self.d
+        env = DummyEnv(py_version="3.4",
+                       envctoxfile=os.path.join(d, "ctox"),
+                       envlockfile=os.path.join(d, "ctox.lock"))
+        self.assertEqual(prev_deps(env), [])
+        with open(env.envctoxfile, 'w') as f:
+            f.write(" pip nose")
+        self.assertEqual(prev_deps(env), ["pip", "nose"])
+        write_json(env.envlockfile, {"python": "3.4",
+                                     "deps": ["pip", "six"]})
+        self.assertEqual(prev_deps(env), ["pip", "six"])
+
+    def test_split_deps_dry_runs(self):
+        d = self.d
+        backend = FakeBackend(missing=['pyfaker'])
+        env = DummyEnv(cachedir=d, name="foo", toxdir=d, backend=backend,
+                       pip="pip", envctoxfile=os.path.join(d, "ctox"),
+                       py_version="3.4", deps=["pip", "pyfaker", "nose"])
+        res = split_deps(env, env.deps)
+        self.assertEqual(res, (["pip", "nose"], ["pyfaker"]))
+        self.assertEqual(backend.calls,
+                         [('not_found', 'foo', ["pip", "pyfaker", "nose"]),
+                          ('not_found', 'foo', ["pip", "nose"])])
+
+        # the second time around we use the index
+        backend.calls = []
+        self.assertEqual(split_deps(env, env.deps), res)
+        self.assertEqual(backend.calls, [])
+
+    def test_install_deps_batched(self):
+        # One conda install of what it can find, one pip install of the rest.
+        from ctox.shell import captured_output
+        d = self.d
+        pip = os.path.join(d, "pip")
+        with open(pip, 'w') as f:
+            f.write(FAKE_PIP_LOG % sys.executable)
+        os.chmod(pip, 0o755)
+        backend = FakeBackend(missing=['pyfaker'])
+        env = DummyEnv(cachedir=d, name="foo", toxdir=d, backend=backend,
+                       pip=pip, envctoxfile=os.path.join(d, "ctox"),
+                       envlockfile=os.path.join(d, "ctox.lock"),
+                       py_version="3.4", deps=["pip", "pyfaker", "nose"])
+        with captured_output():
+            self.assertTrue(install_deps(env))
+        self.assertEqual(backend.calls[-1],
+                         ('install', 'foo', ["pip", "nose"]))
+        with open(pip + ".log") as f:
+            self.assertEqual(f.read().splitlines(),
+                             ["install --quiet pyfaker"])
+        self.assertEqual(prev_deps(env), ["pip", "pyfaker", "nose"])
+
+    def test_install_deps_batch_fails(self):
+        # If the batch fails its deps are dropped from the index (so they're
+        # checked again next time), and each dep is tried on its own.
+        from ctox.cache import index_path, read_json, write_json
+        from ctox.shell import captured_output
+        d = self.d
+        backend = FakeBackend(failing=['install'])
+        env = DummyEnv(cachedir=d, name="foo", toxdir=d, backend=backend,
+                       pip=os.path.join(d, "pip"), py_version="3.4",
+                       envctoxfile=os.path.join(d, "ctox"),
+                       deps=["pip", "nose"])
+        write_json(index_path(env), {"pip": "conda", "nose": "conda",
+                                     "six": "conda"})
+        with captured_output():
+            self.assertFalse(install_deps(env))
+        self.assertEqual(backend.calls,
+                         [('install', 'foo', ["pip", "nose"]),
+                          ('install', 'foo', ["pip"])])
+        self.assertEqual(read_json(index_path(env)), {"six": "conda"})
+
+    def test_create_env_from_cache(self):
+        from ctox.cache import CACHED_MARKER, lock_path, read_json, write_json
+        d = self.d
+        envdir = os.path.join(d, "py34")
+        env = DummyEnv(name="py34", toxdir=d, cachedir=d, envdir=envdir,
+                       envctoxfile=os.path.join(envdir, "ctox"),
+                       envlockfile=os.path.join(envdir, "ctox.lock"),
+                       py_version="3.4", deps=["pip", "nose"],
+                       base_envs=False, backend=FakeBackend())
+        lock = {"python": "3.4", "deps": ["pip", "nose"], "conda": ["a"],
+                "pip": []}
+        write_json(lock_path(env), lock)
+        # What the (fake) clone copied from the cache.
+        os.makedirs(envdir)
+        open(os.path.join(envdir, CACHED_MARKER), 'w').close()
+
+        create_env_from_cache(env, "cached")
+        self.assertEqual(env.backend.calls, [('remove_env', 'py34'),
+                                             ('clone', 'py34', 'cached')])
+        self.assertFalse(os.path.exists(os.path.join(envdir,
+                                                     CACHED_MARKER)))
+        self.assertEqual(prev_deps(env), ["pip", "nose"])
+        self.assertEqual(read_json(env.envlockfile), lock)
+
+    def update_env(self, d, prev, deps, **kwargs):
+        """An env in d which was built with the deps prev."""
+        env = DummyEnv(cachedir=d, name="py34", toxdir=d, py_version="3.4",
+                       pip=os.path.join(d, "pip"), deps=deps,
+                       envctoxfile=os.path.join(d, "ctox"),
+                       envlockfile=os.path.join(d, "ctox.lock"), **kwargs)
+        with open(env.envctoxfile, 'w') as f:
+            f.write(" " + " ".join(prev))
+        return env
+
+    def test_update_deps(self):
+        from ctox.cache import index_path, write_json
+        from ctox.shell import captured_output
+        d = self.d
+        env = self.update_env(d, ["pip", "nose", "six==1.9", "mock"],
+                              ["pip", "nose", "six==1.10", "pytest"],
+                              backend=FakeBackend())
+        write_json(index_path(env), {"mock": "conda"})
+        with captured_output() as (out, _):
+            self.assertTrue(update_deps(env))
+        self.assertTrue("+six==1.10, +pytest, -mock" in out.getvalue())
+        # six isn't removed, installing the new pin changes it.
+        self.assertEqual(env.backend.calls,
+                         [('not_found', 'py34', ["six==1.10", "pytest"]),
+                          ('would_remove', 'py34', ["mock"]),
+                          ('remove', 'py34', ["mock"]),
+                          ('install', 'py34', ["six==1.10", "pytest"]),
+                          ('list_explicit', 'py34')])
+        self.assertEqual(prev_deps(env), env.deps)
+
+    def test_update_deps_dependents(self):
+        # Removing numpy would also remove pandas (which we keep).
+        from ctox.cache import index_path, write_json
+        from ctox.shell import captured_output
+        d = self.d
+        backend = FakeBackend(dependents={"numpy": ["pandas"]})
+        env = self.update_env(d, ["pip", "numpy", "pandas"], ["pip", "pandas"],
+                              backend=backend)
+        write_json(index_path(env), {"numpy": "conda", "pandas": "conda"})
+        with captured_output():
+            self.assertFalse(update_deps(env))
+        self.assertEqual([c[0] for c in backend.calls],
+                         ['would_remove'])
+
+    def test_update_deps_python(self):
+        # Changing python needs a new env.
+        d = self.d
+        env = self.update_env(d, ["pip", "nose"],
+                              ["pip", "nose", "python=3.5"],
+                              backend=FakeBackend())
+        self.assertFalse(update_deps(env))
+        self.assertEqual(env.backend.calls, [])
+
+    def test_update_deps_fails_rebuilds(self):
+        from ctox.shell import captured_output
+        d = self.d
+        builds = []
+        env = self.update_env(d, ["pip", "nose"], ["pip", "nose", "six"],
+                              backend=FakeBackend(failing=['install']),
+                              envdir=d, envdistdir=d,
+                              force_reinstall=False,
+                              env_exists=lambda: True,
+                              reusableable=lambda: True,
+                              build_env=lambda: builds.append(1) or True,
+                              dist_installed=lambda: True)
+        with captured_output() as (out, _):
+            self.assertEqual(env.prepare(), 0)
+        self.assertTrue("rebuilding" in out.getvalue())
+        self.assertEqual(builds, [1])
+
+    def test_dist_installed(self):
+        from ctox.cache import file_hash
+        d = self.d
+        env = DummyEnv(package_zipped=os.path.join(d, "foo-0.1.zip"),
+                       envdistfile=os.path.join(d, "ctox-dist"))
+        with open(env.package_zipped, 'w') as f:
+            f.write("foo")
+        self.assertFalse(dist_installed(env))
+        with open(env.envdistfile, 'w') as f:
+            f.write(file_hash(env.package_zipped))
+        self.assertTrue(dist_installed(env))
+        with open(env.package_zipped, 'w') as f:
+            f.write("bar")
+        self.assertFalse(dist_installed(env))
+
+    def test_build_wheel(self):
+        d = self.d
+        pip = os.path.join(d, "pip")
+        with open(pip, 'w') as f:
+            f.write(FAKE_PIP_WHEEL % sys.executable)
+        os.chmod(pip, 0o755)
+        env = DummyEnv(distdir=os.path.join(d, "dist"), toxdir=d,
+                       py_version="3.4", pip=pip,
+                       package_zipped=os.path.join(d, "foo-0.1.zip"))
+        wheels = os.path.join(env.distdir, "wheels")
+        for old in ("py3.4-aaaaaaaaaaaa", "py2.7-aaaaaaaaaaaa"):
+            os.makedirs(os.path.join(wheels, old))
+
+        wheel = build_wheel(env, "b" * 40)
+        self.assertEqual(wheel, os.path.join(
+            wheels, "py3.4-bbbbbbbbbbbb", "foo-0.1-py2.py3-none-any.whl"))
+        # Only the wheels of previous dists for py3.4 are removed.
+        self.assertEqual(sorted(os.listdir(wheels)),
+                         ["py2.7-aaaaaaaaaaaa", "py3.4-bbbbbbbbbbbb",
+                          "py3.4.lock"])
+
+        # The second time the wheel is reused.
+        env.pip = os.path.join(d, "nopip")
+        self.assertEqual(build_wheel(env, "b" * 40), wheel)
+        self.assertEqual(build_wheel(env, "c" * 40), None)
+
+    def test_install_dist(self):
+        # The wheel is force reinstalled, pip would skip it if a dist with
+        # the same version (but different code) was installed.
+        from ctox.cache import file_hash
+        from ctox.shell import captured_output
+        d = self.d
+        pip = os.path.join(d, "pip")
+        with open(pip, 'w') as f:
+            f.write(FAKE_PIP_WHEEL % sys.executable)
+        os.chmod(pip, 0o755)
+        env = DummyEnv(distdir=os.path.join(d, "dist"), toxdir=d,
+                       py_version="3.4", pip=pip,
+                       package_zipped=os.path.join(d, "foo-0.1.zip"),
+                       envdistfile=os.path.join(d, "ctox-dist"),
+                       force_reinstall=False)
+        with open(env.package_zipped, 'w') as f:
+            f.write("foo")
+        with captured_output():
+            self.assertTrue(install_dist(env))
+        wheel = build_wheel(env, file_hash(env.package_zipped))
+        with open(pip + ".log") as f:
+            install = f.read().splitlines()[-1]
+        self.assertEqual(install, "install %s --no-deps --force-reinstall"
+                         % wheel)
+        self.assertTrue(dist_installed(env))
+
+        # --force-reinstall doesn't use the (possibly stale) wheel.
+        env.force_reinstall = True
+        with captured_output():
+            self.assertTrue(install_dist(env))
+        with open(pip + ".log") as f:
+            install = f.read().splitlines()[-1]
+        self.assertEqual(install, "install %s --no-deps --force-reinstall"
+                         % env.package_zipped)
+
+    def test_base_envs(self):
+        from ctox.cache import base_env_path, is_cached
+        d = self.d
+        backend = FakeBackend()
+        env = DummyEnv(cachedir=d, toxdir=d, name="py34",
+                       envdir=os.path.join(d, "py34"), py_version="3.4",
+                       base_envs=True, backend=backend)
+        base = base_env_path(env)
+        create_env(env)
+        self.assertEqual(backend.calls, [('remove_env', base),
+                                         ('create', base, "3.4"),
+                                         ('clone', "py34", base)])
+        self.assertTrue(is_cached(base))
+        self.assertFalse(is_cached(env.envdir))
+
+        # The base env is reused.
+        backend.calls = []
+        env.name = "py34-extra"
+        env.envdir = os.path.join(d, "py34-extra")
+        create_env(env)
+        self.assertEqual(backend.calls, [('clone', "py34-extra", base)])
+
+    def test_get_backend(self):
+        self.assertEqual(get_backend('mamba').exe, 'mamba')
+        self.assertRaises(KeyError, get_backend, 'foo')
+
+    def test_micromamba_not_found_alone(self):
+        # If micromamba's error can't be parsed, each lib is tried alone.
+        tried = []
+
+        def not_found(self, prefix, libs, cwd):
+            tried.append(libs)
+            if len(libs) > 1 or libs == ["pyfaker"]:
+                return None
+            return []
+
+        orig = CondaBackend.not_found
+        CondaBackend.not_found = not_found
+        try:
+            backend = MicromambaBackend()
+            self.assertEqual(backend.not_found("foo", ["pip", "pyfaker"], "."),
+                             ["pyfaker"])
+            self.assertEqual(tried, [["pip", "pyfaker"], ["pip"], ["pyfaker"]])
+            self.assertEqual(backend.not_found("foo", ["pyfaker"], "."),
+                             ["pyfaker"])
+            self.assertEqual(backend.not_found("foo", ["pip", "nose"], "."),
+                             None)
+        finally:
+            CondaBackend.not_found = orig
+
+    def test_wait_rusage(self):
+        if not hasattr(os, 'wait4'):
+            raise SkipTest("wait4 is not available")
+        p = Popen([sys.executable, "-c", "import sys; sys.exit(3)"])
+        rusage = wait_rusage(p)
+        self.assertEqual(p.returncode, 3)
+        self.assertEqual(sorted(rusage),
+                         ['inblock', 'maxrss', 'oublock', 'sys', 'user'])
+        self.assertTrue(rusage['maxrss'] > 0)
+
+
+# A pip which only logs its arguments (to pip.log).
+FAKE_PIP_LOG = """#!%s
+import sys
+with open(sys.argv[0] + '.log', 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\\n')
+"""
+
+# A pip which logs its arguments (to pip.log) and can only build a wheel (of
+# foo 0.1), see test_build_wheel.
+FAKE_PIP_WHEEL = """#!%s
+import os, sys
+with open(sys.argv[0] + '.log', 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\\n')
+if sys.argv[1] == 'wheel':
+    wheel_dir = sys.argv[sys.argv.index('--wheel-dir') + 1]
+    os.makedirs(wheel_dir)
+    open(os.path.join(wheel_dir, 'foo-0.1-py2.py3-none-any.whl'), 'w').close()
+"""
+
 
 if __name__ == '__main__':
     test_main()
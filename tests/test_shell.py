@@ -0,0 +1,44 @@
+from tests.util import *
+
+from ctox.shell import *
+
+
+class TestShell(TempDirTestCase):
+
+    def test_safe_shell_out_logs(self):
+        d = self.d
+        path = os.path.join(d, "log", "setup.log")
+        cmd = [sys.executable, "-c",
+               "for i in range(100): print(i)\nraise SystemExit(1)"]
+        with log_to(path):
+            self.assertFalse(safe_shell_out(cmd))
+            with captured_output() as (out, _):
+                print_failure()
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[-100:], [str(i) for i in range(100)])
+
+        failed_cmd, tail = last_failure()
+        self.assertEqual(failed_cmd, cmd)
+        expected = ["%d\n" % i for i in range(100 - TAIL_LINES, 100)]
+        self.assertEqual(list(tail), expected)
+        self.assertIn("    99\n", out.getvalue())
+        self.assertIn(path, out.getvalue())
+
+    def test_safe_shell_out_not_found(self):
+        self.assertTrue(safe_shell_out([sys.executable, "-c", "1"]))
+        self.assertFalse(safe_shell_out(["ctox-no-such-command"]))
+
+    def test_prefixed_output(self):
+        r, w = os.pipe()
+        try:
+            out = PrefixedOutput("[py34] ", fd=w)
+            out.write("foo\nba")
+            out.write("r\n")
+            out.write("baz")
+            out.close()
+            self.assertEqual(os.read(r, 1024),
+                             b"[py34] foo\n[py34] bar\n[py34] baz\n")
+        finally:
+            os.close(r)
+            os.close(w)
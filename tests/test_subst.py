@@ -45,6 +45,19 @@ class TestSubst(TestCase):
         exp = ""
         self.assertEqual(res, exp)
 
+    def test_factor_index(self):
+        res = factor_index("nose\npy{33,34}: docformatter\npy27: unify")
+        exp = (['nose', 'docformatter', 'unify'], [0],
+               {'py33': [1], 'py34': [1], 'py27': [2]})
+        self.assertEqual(res, exp)
+
+    def test_expand_factor_lines(self):
+        env = DummyEnv(name='py34-unify')
+        s = "nose\npy{33,34}: docformatter\npy27: unify"
+        res = expand_factor_lines(s, env)
+        exp = ['nose', 'docformatter', '']
+        self.assertEqual(res, exp)
+
     def test_matches_factor_conditions_match(self):
         env = DummyEnv(name='py34')
         s = "py{33, 34}"
@@ -124,6 +137,25 @@ class TestReplaceBraces(TestCase):
         exp = "no posargs passed"
         self.assertEqual(res, exp)
 
+    def test_replace_braces_nested_config(self):
+        from ctox.config import read_config
+        config = read_config(TOXINIFILE)
+        env = DummyEnv(config=config, name="py27", options=[])
+        s = "{[testenv]deps}"
+        res = replace_braces(s, env).split()
+        exp = ['nose', 'colorama', 'conda', 'pyfaker', 'unify']
+        self.assertEqual(res, exp)
+
+    def test_replace_braces_unmatched(self):
+        env = DummyEnv(toxdir="foo")
+        self.assertEqual(replace_braces("{a}b}", DummyEnv(a="x")), "xb}")
+        self.assertEqual(replace_braces("{{toxdir}", env), "{foo")
+
+    def test_compile_template(self):
+        res = compile_template("echo {posargs:{env:USER:} passed}")
+        exp = ['echo ', ('posargs:', ('env:USER:',), ' passed')]
+        self.assertEqual(res, exp)
+
 
 if __name__ == '__main__':
     test_main()
@@ -0,0 +1,43 @@
+from tests.util import *
+
+from ctox.trace import *
+
+
+class TestTrace(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        reset()
+
+    def tearDown(self):
+        TempDirTestCase.tearDown(self)
+        reset()
+
+    def test_span_env(self):
+        with span("setup", cat="phase", env="py34"):
+            with span("conda install"):
+                pass
+        with span("sdist"):
+            pass
+        res = [(s['name'], s['env'], s['depth']) for s in spans()]
+        self.assertEqual(res, [("conda install", "py34", 1),
+                               ("setup", "py34", 0),
+                               ("sdist", "GLOB", 0)])
+
+    def test_command_name(self):
+        self.assertEqual(command_name(["/bin/conda", "install", "-p", "x"]),
+                         "conda install")
+        self.assertEqual(command_name(["pip", "--version"]), "pip")
+
+    def test_write_trace(self):
+        from ctox.cache import read_json
+        with span("runtests", env="py34"):
+            pass
+        d = self.d
+        path = os.path.join(d, "trace.json")
+        write_trace(path, ["py34"], spans())
+        events = read_json(path)['traceEvents']
+        names = [(e['name'], e['ph'], e['tid']) for e in events]
+        self.assertEqual(sorted(names), [("runtests", "X", 1),
+                                         ("thread_name", "M", 0),
+                                         ("thread_name", "M", 1)])
@@ -18,3 +18,54 @@ class DummyEnv(Env):
 
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
+
+
+class TempDirTestCase(TestCase):
+
+    "TestCase with a temporary directory, self.d, which is removed after."
+
+    def setUp(self):
+        from tempfile import mkdtemp
+        self.d = mkdtemp()
+
+    def tearDown(self):
+        from shutil import rmtree
+        rmtree(self.d)
+
+
+class FakeBackend(object):
+
+    """Records the calls made rather than running conda.
+
+    Libs in missing can't be found, removing a lib also removes its
+    dependents and methods in failing fail. create and clone make an (empty)
+    env directory.
+
+    """
+
+    exe = 'fake'
+
+    def __init__(self, missing=(), failing=(), dependents=None):
+        self.missing = missing
+        self.failing = failing
+        self.dependents = dependents or {}
+        self.calls = []
+
+    def __getattr__(self, method):
+        def record(*args, **kwargs):
+            self.calls.append((method,) + args)
+            if method == 'not_found':
+                return [lib for lib in args[1] if lib in self.missing]
+            if method == 'would_remove':
+                return sum(([lib] + self.dependents.get(lib, [])
+                            for lib in args[1]), [])
+            if method == 'list_explicit':
+                return ""
+            if method in self.failing:
+                return False
+            if method in ('create', 'clone'):
+                path = os.path.join(kwargs.get('cwd', ''), args[0])
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+            return True
+        return record